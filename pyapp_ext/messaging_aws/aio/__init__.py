@@ -6,10 +6,19 @@ Messaging integration with AWS SQS and SNS.
 
 """
 
-from .sqs import SQSSender, SQSReceiver
-from .sns import SNSSender, SNSReceiver
+from .sqs import SQSSender, SQSReceiver, SQSMessage
+from .sns import SNSSender, SNSReceiver, SNSMessage
+from .outbox import OutboxSender
 
-__all__ = ("SQSSender", "SQSReceiver", "SNSSender", "SNSReceiver")
+__all__ = (
+    "SQSSender",
+    "SQSReceiver",
+    "SQSMessage",
+    "SNSSender",
+    "SNSReceiver",
+    "SNSMessage",
+    "OutboxSender",
+)
 
 
 class Extension:
@@ -0,0 +1,285 @@
+"""
+Message Deduplication
+~~~~~~~~~~~~~~~~~~~~~
+
+SQS standard queues and SNS subscriptions provide at-least-once delivery, a
+message may be delivered more than once. A :class:`Deduplicator` records the
+keys of successfully processed (deleted) messages so any further deliveries
+can be deleted without being passed to a handler.
+
+Keys are held in a bounded in-memory LRU/TTL cache and optionally in a shared
+backend (eg :class:`SQLiteBackend`) so duplicates are detected across
+processes.
+
+"""
+import abc
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from pyapp_ext.messaging.aio import Message
+
+__all__ = ("DeduplicationBackend", "MemoryBackend", "SQLiteBackend", "Deduplicator")
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 3600
+DEFAULT_PURGE_INTERVAL = 60
+
+
+def message_id(message: Message) -> Optional[str]:
+    """
+    Default key; the ID of the message (the ID of the original message for a
+    re-enqueued delayed message).
+    """
+    return getattr(message, "original_message_id", None) or getattr(message, "message_id", None)
+
+
+class DeduplicationBackend(abc.ABC):
+    """
+    Storage of processed message keys
+    """
+
+    __slots__ = ()
+
+    @abc.abstractmethod
+    async def contains(self, key: str) -> bool:
+        """
+        Key has been recorded (and has not expired)
+        """
+
+    @abc.abstractmethod
+    async def add(self, key: str):
+        """
+        Record a key
+        """
+
+    async def close(self):
+        """
+        Close backend
+        """
+
+
+class MemoryBackend(DeduplicationBackend):
+    """
+    Bounded in-memory LRU cache with a TTL.
+    """
+
+    __slots__ = ("max_size", "ttl", "clock", "_keys")
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_MAX_SIZE,
+        ttl: float = DEFAULT_TTL,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    async def contains(self, key: str) -> bool:
+        keys = self._keys
+        expires = keys.get(key)
+        if expires is None:
+            return False
+
+        if expires <= self.clock():
+            del keys[key]
+            return False
+
+        keys.move_to_end(key)
+        return True
+
+    async def add(self, key: str):
+        keys = self._keys
+        keys[key] = self.clock() + self.ttl
+        keys.move_to_end(key)
+        while len(keys) > self.max_size:
+            keys.popitem(last=False)
+
+
+class SQLiteBackend(DeduplicationBackend):
+    """
+    SQLite backed store, allows keys to be shared between processes on the
+    same host.
+
+    Database operations are performed on a dedicated worker thread, expired
+    keys are purged at most every ``purge_interval`` seconds.
+    """
+
+    __slots__ = (
+        "path",
+        "ttl",
+        "purge_interval",
+        "clock",
+        "_executor",
+        "_connection",
+        "_lock",
+        "_next_purge",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = DEFAULT_TTL,
+        *,
+        purge_interval: float = DEFAULT_PURGE_INTERVAL,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.clock = clock
+        self._executor = None
+        self._connection = None
+        self._lock = None
+        self._next_purge = 0.0
+
+    def __repr__(self):
+        return f"{type(self).__name__}(path={self.path!r})"
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_messages "
+            "(key TEXT PRIMARY KEY, expires REAL NOT NULL)"
+        )
+        connection.commit()
+        self._connection = connection
+        self._purge()
+
+    def _purge(self):
+        now = self.clock()
+        with self._connection:
+            self._connection.execute("DELETE FROM processed_messages WHERE expires <= ?", (now,))
+        self._next_purge = now + self.purge_interval
+
+    def _contains(self, key: str) -> bool:
+        row = self._connection.execute(
+            "SELECT 1 FROM processed_messages WHERE key = ? AND expires > ?",
+            (key, self.clock()),
+        ).fetchone()
+        return row is not None
+
+    def _add(self, key: str):
+        now = self.clock()
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO processed_messages (key, expires) VALUES (?, ?)",
+                (key, now + self.ttl),
+            )
+        if now >= self._next_purge:
+            self._purge()
+
+    async def _run(self, func, *args):
+        if self._connection is None:
+            # Lock is created on first use so it is bound to the running loop
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._connection is None:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(max_workers=1)
+                    await asyncio.get_event_loop().run_in_executor(self._executor, self._connect)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def contains(self, key: str) -> bool:
+        return await self._run(self._contains, key)
+
+    async def add(self, key: str):
+        await self._run(self._add, key)
+
+    async def close(self):
+        if self._executor is not None:
+            if self._connection is not None:
+                await asyncio.get_event_loop().run_in_executor(
+                    self._executor, self._connection.close
+                )
+            self._executor.shutdown()
+            self._executor = self._connection = None
+
+
+class Deduplicator:
+    """
+    Detect messages that have already been processed.
+
+    Messages are recorded once they have been deleted (successfully
+    processed) so a redelivery after a failure is still handled. Keys are
+    scoped to the name of the queue the message was received from; the same
+    message delivered to each queue subscribed to a topic is not a duplicate.
+
+    :param backend: Optional shared backend.
+    :param key: Callable that returns the key of a message; defaults to the
+        message ID. Messages with a key of ``None`` are never duplicates.
+    :param max_size: Maximum size of the in-memory cache.
+    :param ttl: Time (in seconds) a key is held in the in-memory cache.
+
+    """
+
+    __slots__ = ("backend", "key", "_cache")
+
+    def __init__(
+        self,
+        backend: DeduplicationBackend = None,
+        *,
+        key: Callable[[Message], Optional[str]] = message_id,
+        max_size: int = DEFAULT_MAX_SIZE,
+        ttl: float = DEFAULT_TTL,
+    ):
+        self.backend = backend
+        self.key = key
+        self._cache = MemoryBackend(max_size, ttl)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(backend={self.backend!r})"
+
+    def _scoped_key(self, message: Message) -> Optional[str]:
+        key = self.key(message)
+        if key is None:
+            return None
+
+        queue_name = getattr(getattr(message, "queue", None), "queue_name", None)
+        return f"{queue_name}:{key}" if queue_name else key
+
+    async def is_duplicate(self, message: Message) -> bool:
+        """
+        Message has already been processed
+        """
+        key = self._scoped_key(message)
+        if key is None:
+            return False
+
+        if await self._cache.contains(key):
+            return True
+
+        if self.backend is not None and await self.backend.contains(key):
+            await self._cache.add(key)
+            return True
+
+        return False
+
+    async def mark(self, message: Message):
+        """
+        Record a message as processed
+        """
+        key = self._scoped_key(message)
+        if key is None:
+            return
+
+        await self._cache.add(key)
+        if self.backend is not None:
+            await self.backend.add(key)
+
+    async def close(self):
+        """
+        Close the backend
+        """
+        if self.backend is not None:
+            await self.backend.close()
@@ -0,0 +1,190 @@
+"""
+SNS Subscription Filter Policies
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Client side evaluation of SNS subscription filter policies. This allows the
+same policy applied to a subscription to be applied where server side
+filtering is not available (eg a fake backend or a mixed deployment).
+
+"""
+import json
+import operator
+from typing import Any, Dict, Optional, Sequence
+
+__all__ = (
+    "SCOPE_MESSAGE_ATTRIBUTES",
+    "SCOPE_MESSAGE_BODY",
+    "matches",
+    "subscription_attributes",
+    "validate_policy",
+)
+
+SCOPE_MESSAGE_ATTRIBUTES = "MessageAttributes"
+SCOPE_MESSAGE_BODY = "MessageBody"
+
+_MISSING = object()
+
+NUMERIC_OPERATORS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _match_numeric(expression: Sequence[Any], value: Any) -> bool:
+    if not _is_number(value):
+        return False
+    for idx in range(0, len(expression), 2):
+        op, operand = expression[idx], expression[idx + 1]
+        if not NUMERIC_OPERATORS[op](value, operand):
+            return False
+    return True
+
+
+def _match_anything_but(expression: Any, value: Any) -> bool:
+    if isinstance(expression, dict):
+        if "prefix" in expression:
+            return isinstance(value, str) and not value.startswith(expression["prefix"])
+        if "suffix" in expression:
+            return isinstance(value, str) and not value.endswith(expression["suffix"])
+        raise ValueError(f"Unsupported anything-but expression: {expression!r}")
+
+    if isinstance(expression, list):
+        return value not in expression
+
+    return value != expression
+
+
+def _match_condition(condition: Any, value: Any) -> bool:
+    """
+    Match a single condition against a (present) value.
+    """
+    if not isinstance(condition, dict):
+        # Exact match; numeric values compare numerically
+        if _is_number(condition):
+            return _is_number(value) and value == condition
+        return value == condition
+
+    (key, expression), = condition.items()
+    if key == "exists":
+        return bool(expression)
+    if key == "prefix":
+        return isinstance(value, str) and value.startswith(expression)
+    if key == "suffix":
+        return isinstance(value, str) and value.endswith(expression)
+    if key == "equals-ignore-case":
+        return isinstance(value, str) and value.lower() == expression.lower()
+    if key == "numeric":
+        return _match_numeric(expression, value)
+    if key == "anything-but":
+        return _match_anything_but(expression, value)
+
+    raise ValueError(f"Unsupported filter policy operator: {key!r}")
+
+
+def _match_conditions(conditions: Sequence[Any], value: Any) -> bool:
+    if value is _MISSING:
+        return any(
+            isinstance(condition, dict) and condition.get("exists") is False
+            for condition in conditions
+        )
+
+    # Array values match if any element matches
+    values = value if isinstance(value, list) else [value]
+    return any(
+        _match_condition(condition, item) for condition in conditions for item in values
+    )
+
+
+def _validate_condition(condition: Any):
+    if not isinstance(condition, dict):
+        return
+
+    if len(condition) != 1:
+        raise ValueError(f"Filter policy condition must have a single operator: {condition!r}")
+
+    (key, expression), = condition.items()
+    if key == "anything-but":
+        if isinstance(expression, dict) and (
+            len(expression) != 1 or not {"prefix", "suffix"}.issuperset(expression)
+        ):
+            raise ValueError(f"Unsupported anything-but expression: {expression!r}")
+
+    elif key == "numeric":
+        if not isinstance(expression, list) or len(expression) % 2:
+            raise ValueError(f"Invalid numeric expression: {expression!r}")
+        for idx in range(0, len(expression), 2):
+            if expression[idx] not in NUMERIC_OPERATORS or not _is_number(expression[idx + 1]):
+                raise ValueError(f"Invalid numeric expression: {expression!r}")
+
+    elif key not in ("exists", "prefix", "suffix", "equals-ignore-case"):
+        raise ValueError(f"Unsupported filter policy operator: {key!r}")
+
+
+def validate_policy(policy: Dict[str, Any]):
+    """
+    Validate that a filter policy only uses supported operators; raises
+    ``ValueError`` if the policy is invalid.
+    """
+    if not isinstance(policy, dict):
+        raise ValueError(f"Filter policy must be an object: {policy!r}")
+
+    for key, conditions in policy.items():
+        if key == "$or":
+            if not isinstance(conditions, list):
+                raise ValueError("Filter policy $or must be a list of policies")
+            for sub_policy in conditions:
+                validate_policy(sub_policy)
+        elif isinstance(conditions, dict):
+            validate_policy(conditions)
+        elif isinstance(conditions, list):
+            for condition in conditions:
+                _validate_condition(condition)
+        else:
+            raise ValueError(f"Filter policy conditions must be a list: {key!r}")
+
+
+def matches(policy: Dict[str, Any], document: Dict[str, Any]) -> bool:
+    """
+    Determine if a document (message attributes or message body) matches
+    a filter policy.
+
+    All keys in the policy must match, any condition in a key's list of
+    conditions may match. Nested policies are matched against nested objects
+    (message body scope).
+    """
+    for key, conditions in policy.items():
+        if key == "$or":
+            if not any(matches(sub_policy, document) for sub_policy in conditions):
+                return False
+            continue
+
+        value = document.get(key, _MISSING) if isinstance(document, dict) else _MISSING
+        if isinstance(conditions, dict):
+            # A missing nested object is treated as empty (so exists: false matches)
+            if value is _MISSING:
+                value = {}
+            if not isinstance(value, dict) or not matches(conditions, value):
+                return False
+        elif not _match_conditions(conditions, value):
+            return False
+
+    return True
+
+
+def subscription_attributes(
+    policy: Optional[Dict[str, Any]], scope: str = SCOPE_MESSAGE_ATTRIBUTES
+) -> Dict[str, str]:
+    """
+    SNS subscription attributes to apply a filter policy.
+    """
+    if not policy:
+        return {}
+    # Scope is applied first as it determines how the policy is validated
+    return {"FilterPolicyScope": scope, "FilterPolicy": json.dumps(policy)}
@@ -0,0 +1,787 @@
+"""
+Outbox (spooling) Sender
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Messages are appended to a local append-only log and sent by a background
+drainer, ``send_raw`` returns as soon as a message has been written so the
+latency (or availability) of SQS/SNS does not affect the caller.
+
+The log is a directory of fixed size, memory-mapped segment files. Each record
+is prefixed with its length and a CRC32 so a partially written record (eg
+after a crash) marks the end of a segment. The position of the last message
+sent is stored in a ``cursor`` file, segments are removed once drained.
+
+The outbox directory is locked while open, each process requires its own
+outbox directory.
+
+Durability is controlled by the fsync policy:
+
+``always``
+    Segment is flushed to disk before ``send_raw`` returns.
+
+``interval``
+    Segment is flushed at most every ``fsync_interval`` seconds.
+
+``never``
+    Flushing is left to the operating system.
+
+Messages rejected by SQS/SNS (eg an invalid attribute) are never retried, they
+are logged and written to a ``dead-letter`` file in the outbox directory.
+
+"""
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from pyapp.utils import import_type
+from pyapp_ext.messaging.aio import MessageSender
+from pyapp_ext.messaging.exceptions import MessagingError
+
+from .sqs import DEFAULT_DRAIN_TIMEOUT
+from .utils import (
+    MAX_BATCH_BYTES,
+    MAX_MESSAGE_SIZE,
+    RawMessage,
+    Rejected,
+    message_size,
+    permanent_error,
+)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+__all__ = ("FSYNC_ALWAYS", "FSYNC_INTERVAL", "FSYNC_NEVER", "Outbox", "OutboxSender")
+
+LOGGER = logging.getLogger(__name__)
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_SUFFIX = ".segment"
+CURSOR_FILE = "cursor"
+LOCK_FILE = "lock"
+DEAD_LETTER_FILE = "dead-letter"
+
+# Record header; payload length and CRC32 of payload
+HEADER = struct.Struct("<II")
+# Payload prefix; length of metadata
+META_HEADER = struct.Struct("<H")
+
+Position = Tuple[int, int]
+
+
+class OutboxRecord(NamedTuple):
+    """
+    Record read from the outbox
+    """
+
+    position: Position
+    size: int
+    timestamp: float
+    message: RawMessage
+
+
+def encode_record(message: RawMessage, timestamp: float) -> bytes:
+    """
+    Encode a message into a record payload
+    """
+    body = message.body
+    is_str = isinstance(body, str)
+    if is_str:
+        body = body.encode()
+
+    meta = json.dumps(
+        {
+            "t": timestamp,
+            "s": is_str,
+            "ct": message.content_type,
+            "ce": message.content_encoding,
+            "a": message.attributes,
+            "d": message.deliver_at,
+        },
+        separators=(",", ":"),
+    ).encode()
+    return b"".join((META_HEADER.pack(len(meta)), meta, body))
+
+
+def decode_record(payload: bytes) -> Tuple[float, RawMessage]:
+    """
+    Decode a record payload into a message
+    """
+    (meta_len,) = META_HEADER.unpack_from(payload)
+    meta_end = META_HEADER.size + meta_len
+    meta = json.loads(bytes(payload[META_HEADER.size:meta_end]).decode())
+    body = bytes(payload[meta_end:])
+    if meta["s"]:
+        body = body.decode()
+    return meta["t"], RawMessage(body, meta["ct"], meta["ce"], meta["a"], meta.get("d"))
+
+
+class Segment:
+    """
+    Memory-mapped segment file
+    """
+
+    __slots__ = ("segment_id", "path", "size", "write_offset", "_file", "_mmap")
+
+    def __init__(self, segment_id: int, path: str, file, size: int):
+        self.segment_id = segment_id
+        self.path = path
+        self.size = size
+        self._file = file
+        self._mmap = mmap.mmap(file.fileno(), size)
+
+        offset = 0
+        for _, offset, payload in self.records(0):
+            payload.release()
+        self.write_offset = offset
+
+    def __repr__(self):
+        return f"{type(self).__name__}(segment_id={self.segment_id!r})"
+
+    @classmethod
+    def create(cls, directory: str, segment_id: int, size: int) -> "Segment":
+        """
+        Create (and pre-allocate) a new segment
+        """
+        path = os.path.join(directory, f"{segment_id:016d}{SEGMENT_SUFFIX}")
+        file = open(path, "w+b")
+        file.truncate(size)
+        return cls(segment_id, path, file, size)
+
+    @classmethod
+    def load(cls, path: str) -> "Segment":
+        """
+        Load an existing segment
+        """
+        segment_id = int(os.path.basename(path)[: -len(SEGMENT_SUFFIX)])
+        file = open(path, "r+b")
+        return cls(segment_id, path, file, os.path.getsize(path))
+
+    def records(self, offset: int) -> Iterator[Tuple[int, int, memoryview]]:
+        """
+        Iterate over valid records from offset; yields the record offset, the
+        offset of the next record and the payload.
+        """
+        buffer = self._mmap
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(buffer, offset)
+            start = offset + HEADER.size
+            end = start + length
+            if not length or end > self.size:
+                return
+            payload = memoryview(buffer)[start:end]
+            if zlib.crc32(payload) != crc:
+                payload.release()
+                return
+            yield offset, end, payload
+            offset = end
+
+    def append(self, payload: bytes) -> Optional[int]:
+        """
+        Append a record; returns the offset of the record or None if the
+        segment is full.
+        """
+        offset = self.write_offset
+        end = offset + HEADER.size + len(payload)
+        if end > self.size:
+            return None
+
+        buffer = self._mmap
+        buffer[offset + HEADER.size:end] = payload
+        HEADER.pack_into(buffer, offset, len(payload), zlib.crc32(payload))
+        self.write_offset = end
+        return offset
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class Outbox:
+    """
+    Append only log of messages waiting to be sent.
+
+    :param path: Directory used to store the log.
+    :param segment_size: Size of each segment file; this is the maximum
+        size of a single record.
+    :param fsync: Fsync policy; one of ``always``, ``interval`` or ``never``.
+    :param fsync_interval: Maximum time (in seconds) between flushes when
+        using the ``interval`` policy.
+
+    """
+
+    __slots__ = (
+        "path",
+        "segment_size",
+        "fsync",
+        "fsync_interval",
+        "clock",
+        "pending",
+        "pending_bytes",
+        "_segments",
+        "_cursor",
+        "_last_flush",
+        "_lock",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        fsync: str = FSYNC_INTERVAL,
+        fsync_interval: float = 1.0,
+        clock=time.time,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync!r}")
+
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.clock = clock
+        self.pending = 0
+        self.pending_bytes = 0
+
+        self._segments: List[Segment] = []
+        self._cursor: Position = (0, 0)
+        self._last_flush = 0.0
+        self._lock = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(path={self.path!r})"
+
+    @property
+    def _cursor_path(self) -> str:
+        return os.path.join(self.path, CURSOR_FILE)
+
+    def open(self):
+        """
+        Open the outbox and recover any pending messages
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._acquire_lock()
+
+        self._segments = [
+            Segment.load(os.path.join(self.path, name))
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(SEGMENT_SUFFIX)
+        ]
+
+        try:
+            with open(self._cursor_path) as f:
+                self._cursor = tuple(json.load(f))
+        except FileNotFoundError:
+            first = self._segments[0].segment_id if self._segments else 0
+            self._cursor = (first, 0)
+
+        self.pending = self.pending_bytes = 0
+        for _, _, payload in self._records():
+            self.pending += 1
+            self.pending_bytes += len(payload)
+            payload.release()
+
+        if self.pending:
+            LOGGER.info("Recovered %s pending messages from outbox %s", self.pending, self.path)
+
+    def _acquire_lock(self):
+        lock = open(os.path.join(self.path, LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                raise MessagingError(
+                    f"Outbox {self.path} is in use by another process"
+                ) from None
+        self._lock = lock
+
+    def close(self):
+        """
+        Flush and close the outbox
+        """
+        for segment in self._segments:
+            segment.flush()
+            segment.close()
+        self._segments = []
+
+        if self._lock is not None:
+            # Closing the file releases the lock
+            self._lock.close()
+            self._lock = None
+
+    def _records(self) -> Iterator[Tuple[Segment, int, memoryview]]:
+        segment_id, offset = self._cursor
+        for segment in self._segments:
+            if segment.segment_id < segment_id:
+                continue
+            start = offset if segment.segment_id == segment_id else 0
+            for _, next_offset, payload in segment.records(start):
+                yield segment, next_offset, payload
+
+    def flush_due(self, now: float) -> bool:
+        """
+        Current segment should be flushed (based on the fsync policy)
+        """
+        return self.fsync == FSYNC_ALWAYS or (
+            self.fsync == FSYNC_INTERVAL and now - self._last_flush >= self.fsync_interval
+        )
+
+    def flush(self):
+        """
+        Flush the current segment to disk
+        """
+        if self._segments:
+            self._segments[-1].flush()
+        self._last_flush = self.clock()
+
+    def append(self, message: RawMessage, *, flush: bool = True) -> str:
+        """
+        Append a message to the outbox; returns a local ID of the message.
+
+        If ``flush`` is False the caller is responsible for flushing the
+        segment (see :meth:`flush_due`).
+        """
+        now = self.clock()
+        payload = encode_record(message, now)
+        if HEADER.size + len(payload) > self.segment_size:
+            raise ValueError("Message is larger than the outbox segment size")
+
+        offset = self._segments[-1].append(payload) if self._segments else None
+        if offset is None:
+            if self._segments:
+                # Ensure a full segment is persisted before moving on
+                self._segments[-1].flush()
+                segment_id = self._segments[-1].segment_id + 1
+            else:
+                segment_id = self._cursor[0]
+            self._segments.append(Segment.create(self.path, segment_id, self.segment_size))
+            offset = self._segments[-1].append(payload)
+
+        self.pending += 1
+        self.pending_bytes += len(payload)
+
+        if flush and self.flush_due(now):
+            self.flush()
+
+        return f"{self._segments[-1].segment_id}:{offset}"
+
+    def read(self, max_count: int, max_bytes: int = None) -> List[OutboxRecord]:
+        """
+        Read pending messages (in the order they were appended) without
+        removing them.
+
+        If ``max_bytes`` is supplied reading stops before the total size of
+        the messages (see :func:`message_size`) exceeds it; at least one
+        message is always returned.
+        """
+        records = []
+        total_bytes = 0
+        for segment, next_offset, payload in self._records():
+            timestamp, message = decode_record(payload)
+            payload_size = len(payload)
+            payload.release()
+            if max_bytes is not None:
+                total_bytes += message_size(message)
+                if records and total_bytes > max_bytes:
+                    break
+
+            records.append(OutboxRecord(
+                (segment.segment_id, next_offset), payload_size, timestamp, message
+            ))
+            if len(records) >= max_count:
+                break
+        return records
+
+    def oldest_timestamp(self) -> Optional[float]:
+        """
+        Time the oldest pending message was appended
+        """
+        records = self.read(1)
+        return records[0].timestamp if records else None
+
+    def commit(self, records: Sequence[OutboxRecord]):
+        """
+        Mark records (returned by :meth:`read`) as sent
+        """
+        if not records:
+            return
+
+        self._cursor = records[-1].position
+        self.pending -= len(records)
+        self.pending_bytes -= sum(record.size for record in records)
+
+        tmp_path = self._cursor_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._cursor, f)
+            if self.fsync == FSYNC_ALWAYS:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self._cursor_path)
+
+        # Remove drained segments (the current segment is always retained)
+        while len(self._segments) > 1 and self._segments[0].segment_id < self._cursor[0]:
+            self._segments.pop(0).remove()
+        if len(self._segments) > 1 and self._cursor[1] >= self._segments[0].write_offset:
+            segment = self._segments.pop(0)
+            if segment.segment_id == self._cursor[0]:
+                self._cursor = (self._segments[0].segment_id, 0)
+            segment.remove()
+
+    @property
+    def _dead_letter_path(self) -> str:
+        return os.path.join(self.path, DEAD_LETTER_FILE)
+
+    def dead_letter(self, record: OutboxRecord):
+        """
+        Write a record (that can never be sent) to the dead-letter file
+        """
+        payload = encode_record(record.message, record.timestamp)
+        with open(self._dead_letter_path, "ab") as f:
+            f.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def dead_letters(self) -> Iterator[Tuple[float, RawMessage]]:
+        """
+        Iterate over messages in the dead-letter file; yields the time each
+        message was appended to the outbox and the message.
+        """
+        try:
+            with open(self._dead_letter_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                return
+            yield decode_record(payload)
+            offset = start + length
+
+
+class OutboxSender(MessageSender):
+    """
+    Sender that spools messages to a local outbox; messages are sent in
+    batches (in the order they were appended) by a background drainer.
+
+    The ``sender`` is either a sender instance or a type name and arguments
+    (as used in the ``SEND_MESSAGE_QUEUES`` setting) eg::
+
+        SEND_MESSAGE_QUEUES = {
+            "sqs": (
+                "pyapp_ext.messaging_aws.aio.OutboxSender",
+                {
+                    "sender": (
+                        "pyapp_ext.messaging_aws.aio.SQSSender",
+                        {"queue_name": "my-queue"},
+                    ),
+                    "path": "/var/spool/my-app/sqs",
+                },
+            )
+        }
+
+    Sending is retried (with an exponential back-off) until successful, a
+    failed message (and any after it) is retried so messages are sent in
+    order; messages following a failure may be sent more than once. Batches
+    are limited to ``batch_size`` messages and ``max_batch_bytes``. Messages
+    rejected by the service are written to the outbox dead-letter file.
+
+    """
+
+    __slots__ = (
+        "sender",
+        "outbox",
+        "batch_size",
+        "max_batch_bytes",
+        "max_message_size",
+        "retry_delay",
+        "max_retry_delay",
+        "poll_interval",
+        "sent",
+        "rejected",
+        "retries",
+        "last_error",
+        "_task",
+        "_wakeup",
+    )
+
+    def __init__(
+        self,
+        *,
+        sender: Union[MessageSender, Tuple[str, Dict[str, Any]]],
+        path: str,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        fsync: str = FSYNC_INTERVAL,
+        fsync_interval: float = 1.0,
+        batch_size: int = 10,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        max_message_size: int = MAX_MESSAGE_SIZE,
+        retry_delay: float = 0.5,
+        max_retry_delay: float = 60.0,
+        poll_interval: float = 1.0,
+    ):
+        if isinstance(sender, (tuple, list)):
+            type_name, kwargs = sender
+            sender = import_type(type_name)(**kwargs)
+
+        self.sender = sender
+        self.outbox = Outbox(
+            path, segment_size=segment_size, fsync=fsync, fsync_interval=fsync_interval
+        )
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_message_size = max_message_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.sent = 0
+        self.rejected = 0
+        self.retries = 0
+        self.last_error = None
+
+        self._task = None
+        self._wakeup = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(sender={self.sender!r}, path={self.outbox.path!r})"
+
+    async def open(self):
+        """
+        Open the sender and outbox and start the drainer
+        """
+        await self.sender.open()
+        try:
+            self.outbox.open()
+        except Exception:
+            await self.sender.close()
+            raise
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._drain())
+
+    async def _stop_drainer(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def close(self):
+        """
+        Stop the drainer and close the outbox and sender; any pending messages
+        remain in the outbox.
+        """
+        await self._stop_drainer()
+        self.outbox.close()
+        self._wakeup = None
+        await self.sender.close()
+
+    async def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        """
+        Send pending messages (within timeout) and close the outbox and
+        sender. Messages not sent within the timeout remain in the outbox.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+
+        await self._stop_drainer()
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning(
+                "Outbox %s not drained, %s messages pending", self.outbox.path, self.outbox.pending
+            )
+
+        self.outbox.close()
+        self._wakeup = None
+        if hasattr(self.sender, "drain"):
+            await self.sender.drain(max(deadline - loop.time(), 0))
+        else:
+            await self.sender.close()
+
+    async def configure(self):
+        return await self.sender.configure()
+
+    async def send_raw(
+        self,
+        body: bytes,
+        *,
+        content_type: str = None,
+        content_encoding: str = None,
+        attributes: Dict[str, Any] = None,
+        delay: float = None,
+    ) -> str:
+        """
+        Append a raw message to the outbox; returns the local outbox ID of
+        the message.
+
+        A ``delay`` is relative to the time the message is appended, not when
+        the message is sent.
+        """
+        if self._wakeup is None:
+            raise MessagingError("OutboxSender is not open")
+
+        outbox = self.outbox
+        now = outbox.clock()
+        deliver_at = now + delay if delay else None
+        message = RawMessage(body, content_type, content_encoding, attributes, deliver_at)
+        if message_size(message) > self.max_message_size:
+            raise ValueError("Message is larger than the maximum message size")
+
+        message_id = outbox.append(message, flush=False)
+        if outbox.flush_due(now):
+            await self._flush_outbox()
+
+        self._wakeup.set()
+        return message_id
+
+    async def _flush_outbox(self):
+        # Flushing blocks until written to disk, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, self.outbox.flush)
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Backlog metrics
+        """
+        oldest = self.outbox.oldest_timestamp()
+        return {
+            "pending": self.outbox.pending,
+            "pending_bytes": self.outbox.pending_bytes,
+            "oldest_age": (self.outbox.clock() - oldest) if oldest is not None else 0.0,
+            "sent": self.sent,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "last_error": self.last_error,
+        }
+
+    async def _send_batch(self, messages: Sequence[RawMessage]) -> List[Optional[str]]:
+        sender = self.sender
+        if hasattr(sender, "send_raw_batch"):
+            return await sender.send_raw_batch(messages)
+
+        message_ids = []
+        now = self.outbox.clock()
+        for message in messages:
+            kwargs = {"attributes": message.attributes} if message.attributes else {}
+            if message.deliver_at is not None and message.deliver_at > now:
+                kwargs["delay"] = message.deliver_at - now
+            message_ids.append(await sender.send_raw(
+                message.body,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                **kwargs,
+            ))
+        return message_ids
+
+    async def _ship(self, records: Sequence[OutboxRecord]):
+        """
+        Send records, retrying from the first failure until all have been sent
+        """
+        pending = list(records)
+        limit = len(pending)
+        delay = self.retry_delay
+        while pending:
+            batch = pending[:limit]
+            try:
+                message_ids = await self._send_batch([record.message for record in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOGGER.warning("Error sending messages from outbox: %s", ex)
+                self.last_error = str(ex)
+                rejected = permanent_error(ex)
+                if rejected is None:
+                    message_ids = [None] * len(batch)
+                elif len(batch) == 1:
+                    message_ids = [rejected]
+                else:
+                    # Send messages individually to isolate the message that
+                    # can never be sent.
+                    limit = 1
+                    continue
+
+            for idx, (record, message_id) in enumerate(zip(batch, message_ids)):
+                if message_id is None:
+                    pending = pending[idx:]
+                    break
+
+                if isinstance(message_id, Rejected):
+                    LOGGER.error(
+                        "Message rejected, moved to outbox dead-letter file: %s (%s)",
+                        message_id.message,
+                        message_id.code,
+                    )
+                    self.outbox.dead_letter(record)
+                    self.rejected += 1
+                else:
+                    self.sent += 1
+            else:
+                pending = pending[len(batch):]
+                continue
+
+            self.retries += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def flush(self):
+        """
+        Send all pending messages
+        """
+        outbox = self.outbox
+        while True:
+            records = outbox.read(self.batch_size, self.max_batch_bytes)
+            if not records:
+                return
+            await self._ship(records)
+            outbox.commit(records)
+
+    async def _drain(self):
+        outbox = self.outbox
+        wakeup = self._wakeup
+        while True:
+            wakeup.clear()
+            try:
+                await self.flush()
+
+                if outbox.fsync == FSYNC_INTERVAL:
+                    await self._flush_outbox()
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # Keep draining; the error (eg disk full) may be transient
+                LOGGER.exception("Error draining outbox %s", outbox.path)
+                self.last_error = str(ex)
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -3,33 +3,85 @@ AWS SNS Interfaces
 ~~~~~~~~~~~~~~~~~~
 
 """
+import json
 import logging
-from typing import Dict, Any, AsyncGenerator
+import time
+from typing import Dict, Any, Optional, Sequence, List, Callable, Union
 
 import botocore.exceptions
 from pyapp_ext.aiobotocore import aio_create_client, create_client
 from pyapp_ext.messaging.aio import MessageSender, MessageReceiver, Message
 from pyapp_ext.messaging.exceptions import ClientError
 
-from .sqs import SQSReceiver
-from .utils import build_attributes, parse_attributes
+from .filters import (
+    SCOPE_MESSAGE_ATTRIBUTES,
+    SCOPE_MESSAGE_BODY,
+    matches,
+    subscription_attributes,
+    validate_policy,
+)
+from .sqs import SQSReceiver, SQSMessage, DEFAULT_DRAIN_TIMEOUT
+from .utils import (
+    RawMessage,
+    Rejected,
+    build_attributes,
+    parse_sns_attributes,
+    batch_entries,
+    deferred_delivery,
+    parse_batch_response,
+)
 
 LOGGER = logging.getLogger(__name__)
 
 
+class SNSMessage(SQSMessage):
+    """
+    Message published to SNS and received from an SQS subscription.
+
+    The body is the unwrapped SNS message, SNS message attributes are only
+    parsed on access.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_notification(cls, sqs_message: SQSMessage, notification: Dict[str, Any]) -> "SNSMessage":
+        """
+        Create from an SQS message and the decoded SNS notification it contains.
+        """
+        return cls(
+            {
+                "Body": notification["Message"],
+                "MessageAttributes": notification.get("MessageAttributes"),
+                # SNS message ID is consistent across duplicate deliveries
+                "MessageId": notification.get("MessageId", sqs_message.message_id),
+                "ReceiptHandle": sqs_message.receipt_handle,
+            },
+            sqs_message.queue,
+        )
+
+    def _parse_attributes(self, raw_attributes: Dict[str, Any]) -> Dict[str, Any]:
+        return parse_sns_attributes(raw_attributes)
+
+
 class SNSSender(MessageSender):
     """
     AIO SNS message publisher.
     """
 
-    __slots__ = ("topic_name", "aws_config", "client_args", "_client", "_topic_arn")
+    __slots__ = ("topic_name", "aws_config", "client_args", "clock", "_client", "_topic_arn")
 
     def __init__(
-        self, topic_name: str, aws_config: str = None, client_args: Dict[str, Any] = None
+        self,
+        topic_name: str,
+        aws_config: str = None,
+        client_args: Dict[str, Any] = None,
+        clock: Callable[[], float] = time.time,
     ):
         self.topic_name = topic_name
         self.aws_config = aws_config
         self.client_args = client_args or {}
+        self.clock = clock
 
         self._client = None
         self._topic_arn = None
@@ -74,28 +126,97 @@ class SNSSender(MessageSender):
 
         self._topic_arn = None
 
+    async def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        """
+        Complete any pending operations (within timeout) and close the topic
+        """
+        await self.close()
+
     async def send_raw(
-        self, body: bytes, *, content_type: str = None, content_encoding: str = None
+        self,
+        body: bytes,
+        *,
+        content_type: str = None,
+        content_encoding: str = None,
+        attributes: Dict[str, Any] = None,
+        delay: float = None,
     ) -> str:
+        """
+        Publish a raw message (message is raw bytes)
+
+        Additional message attributes can be supplied for use by subscription
+        filter policies. SNS does not support delayed delivery, if a ``delay``
+        is supplied the subscribed receivers re-enqueue the message (with the
+        SQS delay) until it is due.
+        """
+        now = self.clock()
+        deliver_at, _ = deferred_delivery(
+            now + delay if delay else None, now, native_delay=False
+        )
         attributes = build_attributes(
-            ContentType=content_type, ContentEncoding=content_type
+            ContentType=content_type,
+            ContentEncoding=content_encoding,
+            DeliverAt=deliver_at,
+            **(attributes or {}),
         )
         response = await self._client.publish(
             TopicArn=self._topic_arn, Message=body, MessageAttributes=attributes
         )
         return response["MessageId"]
 
+    async def send_raw_batch(
+        self, messages: Sequence[RawMessage]
+    ) -> List[Union[str, Rejected, None]]:
+        """
+        Publish up to 10 raw messages in a single request; returns the ID of
+        each message, None if the message failed or :class:`Rejected` if the
+        message will never be accepted.
+        """
+        response = await self._client.publish_batch(
+            TopicArn=self._topic_arn,
+            PublishBatchRequestEntries=batch_entries(
+                messages, "Message", now=self.clock(), native_delay=False
+            ),
+        )
+        return parse_batch_response(response, len(messages))
+
 
 class SNSReceiver(SQSReceiver, MessageReceiver):
     """
     AIO SQS message receiver, subscribed to SNS topic.
+
+    A filter policy can be supplied to only deliver matching messages to the
+    subscribed queue, the ``filter_policy_scope`` determines if the policy is
+    applied to message attributes or the message body. Set ``filter_locally``
+    to also apply the policy to received messages (eg where the subscription
+    is not managed by this receiver), messages that do not match are deleted.
     """
 
-    __slots__ = ("topic_name", "fallback_to_sqs")
+    __slots__ = ("topic_name", "fallback_to_sqs", "filter_policy", "filter_policy_scope", "filter_locally")
+
+    def __init__(
+        self,
+        *,
+        topic_name: str,
+        queue_name: str = None,
+        fallback_to_sqs: bool = False,
+        filter_policy: Dict[str, Any] = None,
+        filter_policy_scope: str = SCOPE_MESSAGE_ATTRIBUTES,
+        filter_locally: bool = False,
+        **kwargs,
+    ):
+        if filter_policy_scope not in (SCOPE_MESSAGE_ATTRIBUTES, SCOPE_MESSAGE_BODY):
+            raise ValueError(f"Unknown filter policy scope: {filter_policy_scope!r}")
+        # Policies applied only by SNS are validated by SNS (and may use
+        # operators not supported locally)
+        if filter_policy and filter_locally:
+            validate_policy(filter_policy)
 
-    def __init__(self, *, topic_name: str, queue_name: str = None, fallback_to_sqs: bool = False, **kwargs):
         self.topic_name = topic_name
         self.fallback_to_sqs = fallback_to_sqs
+        self.filter_policy = filter_policy
+        self.filter_policy_scope = filter_policy_scope
+        self.filter_locally = filter_locally
         super().__init__(queue_name=queue_name or topic_name, **kwargs)
 
     def __repr__(self):
@@ -114,42 +235,56 @@ class SNSReceiver(SQSReceiver, MessageReceiver):
         """
         pass
 
-    async def receive_raw(self) -> AsyncGenerator[Message, None]:
+    @property
+    def subscription_attributes(self) -> Dict[str, str]:
         """
-        Receive a raw message
+        Attributes applied to the SNS subscription
         """
-        async for sns_message in super().receive_raw():
-            # Unwrap envelope
-            envelope = sns_message.content
+        return subscription_attributes(self.filter_policy, self.filter_policy_scope)
 
+    def filter_message(self, message: SNSMessage) -> bool:
+        """
+        Apply the filter policy to a received message; returns True if the
+        message should be handled.
+        """
+        if not (self.filter_locally and self.filter_policy):
+            return True
+
+        if self.filter_policy_scope == SCOPE_MESSAGE_BODY:
             try:
-                message = envelope["Message"]
-
-            except KeyError:
-                if self.fallback_to_sqs:
-                    LOGGER.warning("Missing `Message` field, not an SNS message?")
-                    yield sns_message
-
-                else:
-                    LOGGER.error("Missing `Message` field, not an SNS message!")
-                    await self.handle_invalid_message(sns_message)
-                    continue
-
-            else:
-                try:
-                    attrs = parse_attributes(
-                        envelope["MessageAttributes"]
-                    )
-                except KeyError:
-                    attrs = {}
+                document = json.loads(message.body)
+            except ValueError:
+                return False
+        else:
+            document = message.attributes
 
-                yield Message(
-                    message,
-                    attrs.get("ContentType"),
-                    attrs.get("ContentEncoding"),
-                    sns_message.envelope,
-                    self
-                )
+        return matches(self.filter_policy, document)
+
+    async def unwrap_message(self, msg: Dict[str, Any]) -> Optional[Message]:
+        """
+        Unwrap the SNS notification from the SQS message
+        """
+        sqs_message = await super().unwrap_message(msg)
+
+        try:
+            notification = json.loads(sqs_message.body)
+            message = SNSMessage.from_notification(sqs_message, notification)
+
+        except (ValueError, TypeError, KeyError):
+            if self.fallback_to_sqs:
+                LOGGER.warning("Missing `Message` field, not an SNS message?")
+                return sqs_message
+
+            LOGGER.error("Missing `Message` field, not an SNS message!")
+            await self.handle_invalid_message(sqs_message)
+            return None
+
+        if not self.filter_message(message):
+            LOGGER.debug("Message filtered by policy")
+            await self.delete(sqs_message)
+            return None
+
+        return message
 
     async def configure(self):
         """
@@ -175,4 +310,12 @@ class SNSReceiver(SQSReceiver, MessageReceiver):
                 subscription_arn = response["SubscriptionArn"]
                 LOGGER.info("Subscription ARN %s", subscription_arn)
 
+                # Apply attributes separately so an existing subscription is updated,
+                # an empty policy removes any existing policy.
+                attributes = self.subscription_attributes or {"FilterPolicy": "{}"}
+                for name, value in attributes.items():
+                    await sns_client.set_subscription_attributes(
+                        SubscriptionArn=subscription_arn, AttributeName=name, AttributeValue=value
+                    )
+
                 return subscription_arn
@@ -3,25 +3,171 @@ AWS SQS Interfaces
 ~~~~~~~~~~~~~~~~~~
 
 """
+import asyncio
 import logging
-from typing import Dict, Any, Optional, AsyncGenerator
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, AsyncGenerator, Union, Sequence, List, Callable, Tuple
 
 import botocore.exceptions
 from pyapp_ext.aiobotocore import aio_create_client
 from pyapp_ext.messaging.aio import MessageSender, MessageReceiver, Message
-from pyapp_ext.messaging.exceptions import QueueNotFound, ClientError
-
-from .utils import parse_attributes, build_attributes
+from pyapp_ext.messaging.exceptions import QueueNotFound, ClientError, MessagingError
+
+from .dedup import Deduplicator
+from .utils import (
+    DELIVER_AT_ATTRIBUTE,
+    MAX_MESSAGE_ATTRIBUTES,
+    ORIGINAL_MESSAGE_ID_ATTRIBUTE,
+    RawMessage,
+    Rejected,
+    parse_attributes,
+    build_attributes,
+    batch_entries,
+    deferred_delivery,
+    parse_batch_response,
+)
 
 LOGGER = logging.getLogger(__name__)
 
+MAX_BATCH_SIZE = 10
+
+DEFAULT_DRAIN_TIMEOUT = 30.0
+DRAIN_POLL_INTERVAL = 0.1
+# Part of the drain timeout reserved to release messages and close the queue
+DRAIN_RELEASE_TIMEOUT = 2.0
+# Default SQS visibility timeout
+DEFAULT_VISIBILITY_TIMEOUT = 30
+
+_UNSET = object()
+
+
+class SQSMessage(Message):
+    """
+    Message received from SQS.
+
+    Only the fields required to process, delete or change the visibility of
+    a message are retained from the receive response; the body is held as
+    returned (without copying) and attributes and content are only decoded
+    on access.
+    """
+
+    __slots__ = (
+        "_body",
+        "_encoded_body",
+        "_raw_attributes",
+        "_attributes",
+        "_message_id",
+        "_receipt_handle",
+        "_queue",
+        "_content",
+    )
+
+    def __init__(self, msg: Dict[str, Any], queue: "SQSReceiver"):
+        # Base class is not initialised, all fields are exposed via properties
+        self._body = msg.get("Body")
+        self._encoded_body = None
+        self._raw_attributes = msg.get("MessageAttributes")
+        self._attributes = None
+        self._message_id = msg.get("MessageId")
+        self._receipt_handle = msg.get("ReceiptHandle")
+        self._queue = queue
+        self._content = _UNSET
+
+    def __repr__(self):
+        return f"{type(self).__name__}(message_id={self._message_id!r})"
+
+    def _parse_attributes(self, raw_attributes: Dict[str, Any]) -> Dict[str, Any]:
+        return parse_attributes(raw_attributes)
+
+    @property
+    def attributes(self) -> Dict[str, Any]:
+        """
+        Message attributes (parsed on first access)
+        """
+        if self._attributes is None:
+            raw_attributes = self._raw_attributes
+            self._attributes = self._parse_attributes(raw_attributes) if raw_attributes else {}
+            self._raw_attributes = None
+        return self._attributes
+
+    def get_attribute(self, name: str) -> Any:
+        """
+        Get a single attribute without parsing all attributes
+        """
+        if self._attributes is not None:
+            return self._attributes.get(name)
+
+        raw_attributes = self._raw_attributes
+        if not raw_attributes or name not in raw_attributes:
+            return None
+        return self._parse_attributes({name: raw_attributes[name]}).get(name)
+
+    @property
+    def body(self) -> Union[str, bytes]:
+        return self._body
+
+    @property
+    def body_view(self) -> memoryview:
+        """
+        Body as a memoryview; str bodies are encoded as UTF-8 (once, on first
+        access).
+        """
+        body = self.body
+        if isinstance(body, str):
+            if self._encoded_body is None:
+                self._encoded_body = body.encode()
+            body = self._encoded_body
+        return memoryview(body)
+
+    @property
+    def content_type(self) -> Optional[str]:
+        return self.attributes.get("ContentType")
+
+    @property
+    def content_encoding(self) -> Optional[str]:
+        return self.attributes.get("ContentEncoding")
+
+    @property
+    def message_id(self) -> Optional[str]:
+        return self._message_id
+
+    @property
+    def original_message_id(self) -> Optional[str]:
+        """
+        ID of the message as first sent; a delayed message that has been
+        re-enqueued is a copy with a new message ID.
+        """
+        return self.get_attribute(ORIGINAL_MESSAGE_ID_ATTRIBUTE) or self._message_id
+
+    @property
+    def receipt_handle(self) -> Optional[str]:
+        return self._receipt_handle
+
+    @property
+    def envelope(self) -> Dict[str, Any]:
+        return {"MessageId": self._message_id, "ReceiptHandle": self._receipt_handle}
+
+    @property
+    def queue(self) -> "SQSReceiver":
+        return self._queue
+
+    @property
+    def content(self) -> Any:
+        """
+        Deserialised content (decoded on first access)
+        """
+        if self._content is _UNSET:
+            self._content = super().content
+        return self._content
+
 
 class SQSBase:
     """
     Base Message Queue
     """
 
-    __slots__ = ("queue_name", "aws_config", "client_args", "_client", "_queue_url", "loop")
+    __slots__ = ("queue_name", "aws_config", "client_args", "clock", "_client", "_queue_url", "loop")
 
     def __init__(
             self,
@@ -29,10 +175,12 @@ class SQSBase:
             queue_name: str,
             aws_config: str = None,
             client_args: Dict[str, Any] = None,
+            clock: Callable[[], float] = time.time,
     ):
         self.queue_name = queue_name
         self.aws_config = aws_config
         self.client_args = client_args or {}
+        self.clock = clock
 
         self._client = None
         self._queue_url: Optional[str] = None
@@ -92,6 +240,12 @@ class SQSBase:
 
             return response["QueueUrl"]
 
+    async def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        """
+        Complete any pending operations (within timeout) and close the queue
+        """
+        await self.close()
+
 
 class SQSSender(SQSBase, MessageSender):
     """
@@ -100,35 +254,161 @@ class SQSSender(SQSBase, MessageSender):
 
     __slots__ = ()
 
-    async def send_raw(self, body: bytes, *, content_type: str = None, content_encoding: str = None) -> str:
+    async def send_raw(
+        self,
+        body: bytes,
+        *,
+        content_type: str = None,
+        content_encoding: str = None,
+        delay: float = None,
+    ) -> str:
         """
         Publish a raw message (message is raw bytes)
+
+        Delivery of the message can be delayed by ``delay`` seconds; delays
+        longer than the SQS limit of 15 minutes are re-enqueued by the
+        receiver until the message is due.
         """
+        now = self.clock()
+        deliver_at, delay_seconds = deferred_delivery(now + delay if delay else None, now)
         attributes = build_attributes(
-            ContentType=content_type, ContentEncoding=content_encoding
+            ContentType=content_type, ContentEncoding=content_encoding, DeliverAt=deliver_at
         )
+        kwargs = {"DelaySeconds": delay_seconds} if delay_seconds else {}
         response = await self._client.send_message(
-            QueueUrl=self._queue_url, MessageBody=body, MessageAttributes=attributes
+            QueueUrl=self._queue_url, MessageBody=body, MessageAttributes=attributes, **kwargs
         )
         return response["MessageId"]
 
+    async def send_raw_batch(
+        self, messages: Sequence[RawMessage]
+    ) -> List[Union[str, Rejected, None]]:
+        """
+        Publish up to 10 raw messages in a single request; returns the ID of
+        each message, None if the message failed or :class:`Rejected` if the
+        message will never be accepted.
+        """
+        response = await self._client.send_message_batch(
+            QueueUrl=self._queue_url,
+            Entries=batch_entries(messages, "MessageBody", now=self.clock()),
+        )
+        return parse_batch_response(response, len(messages))
+
 
 class SQSReceiver(SQSBase, MessageReceiver):
     """
     Message receiving for SQS
+
+    Supply a :class:`Deduplicator` to delete messages that have already been
+    processed without returning them.
+
+    Messages that have been returned but not deleted are tracked as in-flight
+    (until the visibility timeout of the message expires), use :meth:`drain` to
+    shutdown without leaving in-flight messages invisible until their
+    visibility timeout expires.
+
+    The ``visibility_timeout`` (in seconds) of received messages defaults to
+    that of the queue (read on open; this requires the
+    ``sqs:GetQueueAttributes`` permission).
+
+    Delayed messages (with a ``DeliverAt`` attribute) that are not yet due are
+    re-enqueued (with the SQS delay) rather than returned.
     """
 
-    __slots__ = ("wait_time",)
+    __slots__ = (
+        "wait_time",
+        "visibility_timeout",
+        "deduplicator",
+        "_visibility_timeout",
+        "_draining",
+        "_poll",
+        "_in_flight",
+        "_buffered",
+    )
 
-    def __init__(self, *, wait_time: int = 10, **kwargs):
+    def __init__(
+        self,
+        *,
+        wait_time: int = 10,
+        visibility_timeout: int = None,
+        deduplicator: Deduplicator = None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.deduplicator = deduplicator
+
+        self._visibility_timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
+        self._draining = False
+        self._poll = None
+        # Receipt handle -> (time received, message)
+        self._in_flight = OrderedDict()
+        # Messages received but not yet returned; (time received, message)
+        self._buffered = deque()
+
+    async def open(self):
+        self._draining = False
+        self._in_flight.clear()
+        self._buffered.clear()
+        await super().open()
+
+        if self.visibility_timeout is None:
+            try:
+                response = await self._client.get_queue_attributes(
+                    QueueUrl=self._queue_url, AttributeNames=["VisibilityTimeout"]
+                )
+
+            except botocore.exceptions.ClientError as ex:
+                await self.close()
+                raise ClientError(ex.response["Error"]["Code"]) from ex
+
+            except Exception as ex:
+                await self.close()
+                raise ClientError() from ex
+
+            self._visibility_timeout = int(response["Attributes"]["VisibilityTimeout"])
+
+    async def close(self):
+        await super().close()
+        if self.deduplicator is not None:
+            await self.deduplicator.close()
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Count of messages returned that have not been deleted
+        """
+        self._expire_in_flight()
+        return len(self._in_flight)
+
+    def _expire_in_flight(self):
+        # Discard messages whose visibility timeout has expired (eg the handler
+        # failed); they are visible again so are no longer in-flight.
+        in_flight = self._in_flight
+        expired = time.monotonic() - self._visibility_timeout
+        while in_flight:
+            received, _ = next(iter(in_flight.values()))
+            if received > expired:
+                break
+            in_flight.popitem(last=False)
+
+    def _track(self, received: float, message: Message):
+        self._in_flight[message.envelope["ReceiptHandle"]] = (received, message)
+        self._expire_in_flight()
 
     async def handle_invalid_message(self, message: Message):
         """
         Handle an invalid message
         """
 
+    async def unwrap_message(self, msg: Dict[str, Any]) -> Optional[Message]:
+        """
+        Create a message from an SQS message structure; returns None if the
+        message has been handled and should not be returned.
+        """
+        return SQSMessage(msg, self)
+
     async def receive_raw(self) -> AsyncGenerator[Message, None]:
         """
         Start receiving raw responses from the queue
@@ -136,41 +416,216 @@ class SQSReceiver(SQSBase, MessageReceiver):
         queue_name = self.queue_name
         client = self._client
         queue_url = self._queue_url
+        deduplicator = self.deduplicator
 
         LOGGER.debug("Starting SQS Listener: %s", queue_name)
 
-        while True:
-            response = await client.receive_message(
+        kwargs = {}
+        if self.visibility_timeout is not None:
+            kwargs["VisibilityTimeout"] = self.visibility_timeout
+
+        while not self._draining:
+            # Poll is cleared once any received messages are buffered
+            self._poll = poll = asyncio.ensure_future(client.receive_message(
                 QueueUrl=queue_url,
                 WaitTimeSeconds=self.wait_time,
-                MessageAttributeNames=["ContentType", "ContentEncoding"],
-            )
-
-            if "Messages" in response:
-                for msg in response["Messages"]:
-                    try:
-                        attrs = parse_attributes(
-                            msg["MessageAttributes"]
-                        )
-                    except KeyError:
-                        attrs = {}
-
-                    yield Message(
-                        msg.get("Body"),
-                        attrs.get("ContentType"),
-                        attrs.get("ContentEncoding"),
-                        msg,
-                        self
-                    )
-
-            else:
-                LOGGER.debug("No messages in queue %s", queue_name)
+                # All attributes are required to re-enqueue delayed messages
+                MessageAttributeNames=["All"],
+                **kwargs,
+            ))
+            try:
+                try:
+                    response = await poll
+                except asyncio.CancelledError:
+                    if self._draining and poll.cancelled():
+                        break
+                    raise
+
+                if "Messages" in response:
+                    # Visibility timeout starts (at the latest) once the response is received
+                    received = time.monotonic()
+                    duplicates = []
+                    deferred = []
+                    now = self.clock()
+                    for msg in response["Messages"]:
+                        message = await self.unwrap_message(msg)
+                        if message is None:
+                            continue
+
+                        deliver_at = self._deliver_at(message)
+                        if deliver_at is not None and deliver_at > now:
+                            deferred.append((msg, message, deliver_at))
+
+                        elif deduplicator is not None and await deduplicator.is_duplicate(message):
+                            LOGGER.debug("Duplicate message %r", message)
+                            duplicates.append(message)
+                        else:
+                            self._buffered.append((received, message))
+
+                    # Remove duplicates before returning any messages
+                    if duplicates:
+                        await self.delete_batch(duplicates)
+
+                    if deferred:
+                        await self.reenqueue_batch(deferred, now)
+
+                else:
+                    LOGGER.debug("No messages in queue %s", queue_name)
+
+            finally:
+                self._poll = None
+
+            # Buffered messages are released by drain once draining has started
+            buffered = self._buffered
+            while buffered and not self._draining:
+                received, message = buffered.popleft()
+                self._track(received, message)
+                yield message
+
+    def _check_open(self):
+        if self._client is None:
+            # Eg a handler completed after the receiver was drained, the
+            # message has been released and will be redelivered.
+            raise MessagingError(f"Unable to delete message, queue {self.queue_name} is closed")
 
     async def delete(self, message: Message):
         """
         Delete a message from the queue (eg after successfully processing)
         """
+        self._check_open()
+        receipt_handle = message.envelope["ReceiptHandle"]
         await self._client.delete_message(
             QueueUrl=self._queue_url,
-            ReceiptHandle=message.envelope["ReceiptHandle"]
+            ReceiptHandle=receipt_handle
         )
+        self._in_flight.pop(receipt_handle, None)
+
+        if self.deduplicator is not None:
+            await self.deduplicator.mark(message)
+
+    async def _batch_request(self, method, action: str, messages: Sequence[Message], **extra):
+        for idx in range(0, len(messages), MAX_BATCH_SIZE):
+            response = await method(
+                QueueUrl=self._queue_url,
+                Entries=[
+                    dict(Id=str(entry_id), ReceiptHandle=message.envelope["ReceiptHandle"], **extra)
+                    for entry_id, message in enumerate(messages[idx:idx + MAX_BATCH_SIZE])
+                ],
+            )
+            for failure in response.get("Failed", ()):
+                LOGGER.warning(
+                    "Unable to %s message from %s: %s", action, self.queue_name, failure.get("Message")
+                )
+
+    async def delete_batch(self, messages: Sequence[Message]):
+        """
+        Delete multiple messages from the queue (in batches of up to 10)
+        """
+        self._check_open()
+        await self._batch_request(self._client.delete_message_batch, "delete", messages)
+        for message in messages:
+            self._in_flight.pop(message.envelope["ReceiptHandle"], None)
+
+    async def release_batch(self, messages: Sequence[Message]):
+        """
+        Release multiple messages (in batches of up to 10) by resetting their
+        visibility timeout so they can be received again immediately.
+        """
+        await self._batch_request(
+            self._client.change_message_visibility_batch, "release", messages, VisibilityTimeout=0
+        )
+        for message in messages:
+            self._in_flight.pop(message.envelope["ReceiptHandle"], None)
+
+    @staticmethod
+    def _deliver_at(message: Message) -> Optional[float]:
+        # Avoid parsing all attributes of every received message
+        get_attribute = getattr(message, "get_attribute", None)
+        if get_attribute is None:
+            return None
+
+        value = get_attribute(DELIVER_AT_ATTRIBUTE)
+
+        if value is None:
+            return None
+
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            LOGGER.warning("Invalid %s attribute: %r", DELIVER_AT_ATTRIBUTE, value)
+            return None
+
+    async def reenqueue_batch(
+        self, deferred: Sequence[Tuple[Dict[str, Any], Message, float]], now: float
+    ):
+        """
+        Re-send delayed messages that are not yet due (as received from SQS) with
+        the SQS delay, messages that are re-sent are deleted.
+
+        Each copy has a new message ID, the ID of the original message is kept
+        in the ``OriginalMessageId`` attribute (see
+        :attr:`SQSMessage.original_message_id`).
+        """
+        for idx in range(0, len(deferred), MAX_BATCH_SIZE):
+            batch = deferred[idx:idx + MAX_BATCH_SIZE]
+            entries = []
+            for entry_id, (msg, message, deliver_at) in enumerate(batch):
+                attributes = dict(msg.get("MessageAttributes") or {})
+                if (
+                    ORIGINAL_MESSAGE_ID_ATTRIBUTE not in attributes
+                    and len(attributes) < MAX_MESSAGE_ATTRIBUTES
+                    and msg.get("MessageId")
+                ):
+                    attributes[ORIGINAL_MESSAGE_ID_ATTRIBUTE] = {
+                        "DataType": "String", "StringValue": msg["MessageId"]
+                    }
+                entries.append({
+                    "Id": str(entry_id),
+                    "MessageBody": msg["Body"],
+                    "MessageAttributes": attributes,
+                    "DelaySeconds": deferred_delivery(deliver_at, now)[1],
+                })
+
+            response = await self._client.send_message_batch(
+                QueueUrl=self._queue_url, Entries=entries
+            )
+            message_ids = parse_batch_response(response, len(batch))
+            await self.delete_batch([
+                message for (_, message, _), message_id in zip(batch, message_ids)
+                if isinstance(message_id, str)
+            ])
+
+    async def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT):
+        """
+        Gracefully shutdown the receiver.
+
+        Polling is stopped (any long-poll in progress is allowed to complete
+        within the timeout), in-flight messages are given until the timeout to
+        be processed and any remaining messages are released before the
+        queue is closed. Part of the timeout (up to ``DRAIN_RELEASE_TIMEOUT``)
+        is reserved to release messages and close the queue.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout - min(timeout / 2, DRAIN_RELEASE_TIMEOUT)
+        self._draining = True
+
+        poll = self._poll
+        if poll is not None:
+            await asyncio.wait([poll], timeout=max(deadline - loop.time(), 0))
+            if not poll.done():
+                poll.cancel()
+
+        # Wait for the receive loop to buffer the result of any poll and for
+        # in-flight messages to be processed.
+        while (self._poll is not None or self.in_flight) and loop.time() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+        messages = [message for _, message in self._buffered] + [
+            message for _, message in self._in_flight.values()
+        ]
+        self._buffered.clear()
+        if messages and self._client:
+            LOGGER.info("Releasing %s messages to %s", len(messages), self.queue_name)
+            await self.release_batch(messages)
+
+        await self.close()
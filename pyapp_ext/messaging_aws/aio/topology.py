@@ -0,0 +1,561 @@
+"""
+AWS Topology Provisioning
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Bulk provisioning of the SQS queues, SNS topics and subscriptions declared in
+the ``SEND_MESSAGE_QUEUES`` and ``RECEIVE_MESSAGE_QUEUES`` settings.
+
+The provisioner loads the current state from AWS, computes the difference to
+the declared topology and then applies only the required changes, concurrently
+with a bounded number of in-flight requests.
+
+"""
+import asyncio
+import fnmatch
+import json
+import logging
+from typing import Dict, Any, Optional, Sequence, NamedTuple, List, Tuple, Iterable
+
+import botocore.exceptions
+from pyapp.conf import settings
+from pyapp.utils import import_type
+from pyapp_ext.aiobotocore import aio_create_client
+from pyapp_ext.messaging.exceptions import ClientError
+
+from .filters import SCOPE_MESSAGE_ATTRIBUTES, subscription_attributes
+from .outbox import OutboxSender
+from .sns import SNSSender, SNSReceiver
+from .sqs import SQSBase
+
+__all__ = ("Subscription", "Topology", "TopologyPlan", "TopologyProvisioner", "provision")
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 10
+# SQS only paginates list_queues when a page size is supplied
+LIST_QUEUES_PAGE_SIZE = 1000
+
+
+class Subscription(NamedTuple):
+    """
+    SNS topic to SQS queue subscription
+    """
+
+    topic_name: str
+    queue_name: str
+    filter_policy: Optional[Dict[str, Any]] = None
+    filter_policy_scope: str = SCOPE_MESSAGE_ATTRIBUTES
+
+    @property
+    def attributes(self) -> Dict[str, str]:
+        """
+        Subscription attributes
+        """
+        return subscription_attributes(self.filter_policy, self.filter_policy_scope)
+
+
+class Topology(NamedTuple):
+    """
+    Declared (or existing) topology
+    """
+
+    queues: frozenset
+    topics: frozenset
+    subscriptions: Tuple[Subscription, ...]
+
+
+class TopologyPlan(NamedTuple):
+    """
+    Changes required to bring AWS in line with the declared topology
+    """
+
+    create_topics: Tuple[str, ...]
+    create_queues: Tuple[str, ...]
+    set_queue_policies: Tuple[str, ...]
+    subscribe: Tuple[Subscription, ...]
+    update_filter_policies: Tuple[Tuple[str, Subscription], ...]
+
+    def __bool__(self):
+        return any(self)
+
+    def __str__(self):
+        lines = []
+        lines.extend(f"+ topic {name}" for name in self.create_topics)
+        lines.extend(f"+ queue {name}" for name in self.create_queues)
+        lines.extend(f"~ queue policy {name}" for name in self.set_queue_policies)
+        lines.extend(
+            f"+ subscription {sub.topic_name} -> {sub.queue_name}"
+            for sub in self.subscribe
+        )
+        lines.extend(
+            f"~ filter policy {arn}" for arn, _ in self.update_filter_policies
+        )
+        return "\n".join(lines) or "No changes"
+
+
+def _name_from_arn(arn: str) -> str:
+    return arn.rsplit(":", 1)[-1]
+
+
+def _name_from_url(url: str) -> str:
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def queue_policy(queue_arn: str, topic_arns: Iterable[str]) -> Dict[str, Any]:
+    """
+    Generate a queue policy that allows SNS to deliver messages from the topics
+    into the queue.
+    """
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": f"sns-{_name_from_arn(topic_arn)}",
+                "Effect": "Allow",
+                "Principal": {"Service": "sns.amazonaws.com"},
+                "Action": "sqs:SendMessage",
+                "Resource": queue_arn,
+                "Condition": {"ArnEquals": {"aws:SourceArn": topic_arn}},
+            }
+            for topic_arn in sorted(topic_arns)
+        ],
+    }
+
+
+def _load_policy(policy: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not policy:
+        return None
+    try:
+        document = json.loads(policy)
+    except ValueError:
+        return None
+    return document if isinstance(document, dict) else None
+
+
+def _statements(document: Dict[str, Any]) -> List[Any]:
+    # A single statement may be supplied as an object rather than a list
+    statements = document.get("Statement") or []
+    return [statements] if isinstance(statements, dict) else list(statements)
+
+
+def _as_list(value: Any) -> List[Any]:
+    return value if isinstance(value, list) else [value]
+
+
+def _disallowed_topics(
+    statements: Sequence[Any], queue_arn: str, topic_arns: Iterable[str]
+) -> List[str]:
+    """
+    Topics not allowed to send messages to the queue by the policy statements.
+    """
+    equals, like = set(), []
+    for statement in statements:
+        if not isinstance(statement, dict) or statement.get("Effect") != "Allow":
+            continue
+        if queue_arn not in _as_list(statement.get("Resource")):
+            continue
+        condition = statement.get("Condition") or {}
+        equals.update(_as_list((condition.get("ArnEquals") or {}).get("aws:SourceArn")))
+        like.extend(_as_list((condition.get("ArnLike") or {}).get("aws:SourceArn")))
+
+    return [
+        topic_arn
+        for topic_arn in topic_arns
+        if topic_arn not in equals
+        and not any(
+            isinstance(pattern, str) and fnmatch.fnmatchcase(topic_arn, pattern)
+            for pattern in like
+        )
+    ]
+
+
+def _policy_allows(policy: Optional[str], queue_arn: str, topic_arns: Iterable[str]) -> bool:
+    """
+    Determine if an existing policy document already allows all topics.
+    """
+    document = _load_policy(policy)
+    if document is None:
+        return False
+    return not _disallowed_topics(_statements(document), queue_arn, topic_arns)
+
+
+def merge_queue_policy(
+    policy: Optional[str], queue_arn: str, topic_arns: Iterable[str]
+) -> Dict[str, Any]:
+    """
+    Merge statements allowing SNS to deliver messages from the topics into an
+    existing queue policy; existing statements are retained.
+    """
+    document = _load_policy(policy) or {"Version": "2012-10-17"}
+    statements = _statements(document)
+    added = queue_policy(queue_arn, _disallowed_topics(statements, queue_arn, topic_arns))
+    sids = {statement["Sid"] for statement in added["Statement"]}
+    document["Statement"] = [
+        statement
+        for statement in statements
+        if not (isinstance(statement, dict) and statement.get("Sid") in sids)
+    ] + added["Statement"]
+    return document
+
+
+def _client_key(queue) -> Tuple[Optional[str], str]:
+    return queue.aws_config, json.dumps(queue.client_args, sort_keys=True, default=repr)
+
+
+class TopologyProvisioner:
+    """
+    Provision the topology declared by a set of queue instances.
+
+    All queues must share the same AWS config and client arguments, use
+    :func:`provision` to provision directly from settings.
+    """
+
+    __slots__ = (
+        "queues",
+        "aws_config",
+        "client_args",
+        "concurrency",
+        "_semaphore",
+        "_sqs_client",
+        "_sns_client",
+        "_queue_urls",
+        "_queue_arns",
+        "_topic_arns",
+        "_subscriptions",
+    )
+
+    def __init__(
+        self,
+        queues: Sequence[Any],
+        *,
+        aws_config: str = None,
+        client_args: Dict[str, Any] = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.queues = queues
+        self.aws_config = aws_config
+        self.client_args = client_args or {}
+        self.concurrency = concurrency
+
+        self._semaphore = None
+        self._sqs_client = None
+        self._sns_client = None
+        self._queue_urls: Dict[str, str] = {}
+        self._queue_arns: Dict[str, str] = {}
+        self._topic_arns: Dict[str, str] = {}
+        # (topic_name, queue_arn) -> (subscription_arn, filter_policy, filter_policy_scope)
+        self._subscriptions: Dict[Tuple[str, str], Tuple[str, Optional[dict], str]] = {}
+
+    def __repr__(self):
+        return f"{type(self).__name__}(queues={len(self.queues)!r})"
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        """
+        Open shared clients
+        """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._sqs_client = await aio_create_client("sqs", self.aws_config, **self.client_args)
+        try:
+            self._sns_client = await aio_create_client("sns", self.aws_config, **self.client_args)
+        except Exception:
+            await self._sqs_client.close()
+            self._sqs_client = None
+            raise
+
+    async def close(self):
+        """
+        Close shared clients
+        """
+        for client in (self._sqs_client, self._sns_client):
+            if client:
+                await client.close()
+        self._sqs_client = self._sns_client = None
+
+    def desired(self) -> Topology:
+        """
+        Topology declared by the queues.
+        """
+        queues = set()
+        topics = set()
+        subscriptions = {}
+
+        for queue in self.queues:
+            if isinstance(queue, SNSReceiver):
+                topics.add(queue.topic_name)
+                queues.add(queue.queue_name)
+                key = (queue.topic_name, queue.queue_name)
+                subscriptions[key] = Subscription(
+                    queue.topic_name,
+                    queue.queue_name,
+                    queue.filter_policy,
+                    queue.filter_policy_scope,
+                )
+            elif isinstance(queue, SNSSender):
+                topics.add(queue.topic_name)
+            elif isinstance(queue, SQSBase):
+                queues.add(queue.queue_name)
+
+        return Topology(
+            frozenset(queues),
+            frozenset(topics),
+            tuple(subscriptions[key] for key in sorted(subscriptions)),
+        )
+
+    async def _call(self, method, **kwargs):
+        async with self._semaphore:
+            try:
+                return await method(**kwargs)
+            except botocore.exceptions.ClientError as ex:
+                error_code = ex.response["Error"]["Code"]
+                raise ClientError(error_code) from ex
+
+    async def _paginate(self, method, result_key: str, **kwargs) -> List[Any]:
+        results = []
+        while True:
+            response = await self._call(method, **kwargs)
+            results.extend(response.get(result_key, []))
+            next_token = response.get("NextToken")
+            if not next_token:
+                return results
+            kwargs["NextToken"] = next_token
+
+    async def _load_queue_arn(self, queue_name: str) -> Optional[str]:
+        response = await self._call(
+            self._sqs_client.get_queue_attributes,
+            QueueUrl=self._queue_urls[queue_name],
+            AttributeNames=["QueueArn", "Policy"],
+        )
+        attributes = response["Attributes"]
+        self._queue_arns[queue_name] = attributes["QueueArn"]
+        return attributes.get("Policy")
+
+    async def _load_subscription(self, topic_name: str, subscription: Dict[str, Any]):
+        response = await self._call(
+            self._sns_client.get_subscription_attributes,
+            SubscriptionArn=subscription["SubscriptionArn"],
+        )
+        attributes = response["Attributes"]
+        filter_policy = attributes.get("FilterPolicy")
+        self._subscriptions[(topic_name, subscription["Endpoint"])] = (
+            subscription["SubscriptionArn"],
+            json.loads(filter_policy) if filter_policy else None,
+            attributes.get("FilterPolicyScope", SCOPE_MESSAGE_ATTRIBUTES),
+        )
+
+    async def _load_subscriptions(self, topic_name: str):
+        topic_arn = self._topic_arns[topic_name]
+        subscriptions = await self._paginate(
+            self._sns_client.list_subscriptions_by_topic, "Subscriptions", TopicArn=topic_arn
+        )
+        # Only the attributes of subscriptions to managed queues are required
+        queue_arns = set(self._queue_arns.values())
+        await asyncio.gather(*(
+            self._load_subscription(topic_name, subscription)
+            for subscription in subscriptions
+            if subscription.get("Protocol") == "sqs" and subscription.get("Endpoint") in queue_arns
+        ))
+
+    async def plan(self) -> TopologyPlan:
+        """
+        Load the current state from AWS and compute the changes required.
+        """
+        desired = self.desired()
+
+        queue_urls, topic_arns = await asyncio.gather(
+            self._paginate(
+                self._sqs_client.list_queues, "QueueUrls", MaxResults=LIST_QUEUES_PAGE_SIZE
+            ),
+            self._paginate(self._sns_client.list_topics, "Topics"),
+        )
+        self._queue_urls = {_name_from_url(url): url for url in queue_urls}
+        self._topic_arns = {
+            _name_from_arn(topic["TopicArn"]): topic["TopicArn"] for topic in topic_arns
+        }
+        # Topics can be declared using their ARN
+        for topic_name in desired.topics:
+            if topic_name.startswith("arn:"):
+                self._topic_arns[topic_name] = topic_name
+
+        create_topics = tuple(sorted(desired.topics - set(self._topic_arns)))
+        create_queues = tuple(sorted(desired.queues - set(self._queue_urls)))
+
+        # Load state of existing queues/topics that are part of a subscription
+        subscribed_queues = sorted(
+            {sub.queue_name for sub in desired.subscriptions} - set(create_queues)
+        )
+        subscribed_topics = sorted(
+            {sub.topic_name for sub in desired.subscriptions} - set(create_topics)
+        )
+        policies = await asyncio.gather(
+            *(self._load_queue_arn(name) for name in subscribed_queues)
+        )
+        await asyncio.gather(*(self._load_subscriptions(name) for name in subscribed_topics))
+
+        set_queue_policies = set(create_queues) & {sub.queue_name for sub in desired.subscriptions}
+        subscribe = []
+        update_filter_policies = []
+        for queue_name, policy in zip(subscribed_queues, policies):
+            topic_names = [
+                sub.topic_name for sub in desired.subscriptions if sub.queue_name == queue_name
+            ]
+            # Unknown topic ARNs (topic is to be created) always require an update.
+            if not all(name in self._topic_arns for name in topic_names) or not _policy_allows(
+                policy,
+                self._queue_arns[queue_name],
+                (self._topic_arns[name] for name in topic_names),
+            ):
+                set_queue_policies.add(queue_name)
+
+        for sub in desired.subscriptions:
+            existing = self._subscriptions.get(
+                (sub.topic_name, self._queue_arns.get(sub.queue_name))
+            )
+            if existing is None:
+                subscribe.append(sub)
+            elif existing[1] != sub.filter_policy or (
+                sub.filter_policy and existing[2] != sub.filter_policy_scope
+            ):
+                update_filter_policies.append((existing[0], sub))
+
+        return TopologyPlan(
+            create_topics,
+            create_queues,
+            tuple(sorted(set_queue_policies)),
+            tuple(subscribe),
+            tuple(update_filter_policies),
+        )
+
+    async def _create_topic(self, topic_name: str):
+        response = await self._call(self._sns_client.create_topic, Name=topic_name)
+        self._topic_arns[topic_name] = response["TopicArn"]
+        LOGGER.info("Created topic %s", response["TopicArn"])
+
+    async def _create_queue(self, queue_name: str):
+        response = await self._call(self._sqs_client.create_queue, QueueName=queue_name)
+        self._queue_urls[queue_name] = response["QueueUrl"]
+        LOGGER.info("Created queue %s", response["QueueUrl"])
+
+    async def _set_queue_policy(self, queue_name: str, topic_names: Iterable[str]):
+        # Reload the current policy so statements added since planning are retained
+        current = await self._load_queue_arn(queue_name)
+        queue_arn = self._queue_arns[queue_name]
+        policy = merge_queue_policy(
+            current, queue_arn, [self._topic_arns[name] for name in topic_names]
+        )
+        await self._call(
+            self._sqs_client.set_queue_attributes,
+            QueueUrl=self._queue_urls[queue_name],
+            Attributes={"Policy": json.dumps(policy)},
+        )
+        LOGGER.info("Updated queue policy %s", queue_arn)
+
+    async def _subscribe(self, subscription: Subscription):
+        kwargs = {}
+        if subscription.filter_policy:
+            kwargs["Attributes"] = subscription.attributes
+        response = await self._call(
+            self._sns_client.subscribe,
+            TopicArn=self._topic_arns[subscription.topic_name],
+            Endpoint=self._queue_arns[subscription.queue_name],
+            Protocol="sqs",
+            ReturnSubscriptionArn=True,
+            **kwargs,
+        )
+        LOGGER.info("Subscription ARN %s", response["SubscriptionArn"])
+
+    async def _update_filter_policy(self, subscription_arn: str, subscription: Subscription):
+        # An empty policy removes any existing policy
+        attributes = subscription.attributes or {"FilterPolicy": "{}"}
+        for name, value in attributes.items():
+            await self._call(
+                self._sns_client.set_subscription_attributes,
+                SubscriptionArn=subscription_arn,
+                AttributeName=name,
+                AttributeValue=value,
+            )
+        LOGGER.info("Updated filter policy %s", subscription_arn)
+
+    async def apply(self, plan: TopologyPlan = None) -> TopologyPlan:
+        """
+        Apply a plan (or plan and apply if no plan is supplied).
+
+        Changes are applied in dependency order (topics and queues, queue
+        policies and finally subscriptions), each stage is applied concurrently.
+        """
+        if plan is None:
+            plan = await self.plan()
+
+        await asyncio.gather(
+            *(self._create_topic(name) for name in plan.create_topics),
+            *(self._create_queue(name) for name in plan.create_queues),
+        )
+
+        desired = self.desired()
+        await asyncio.gather(
+            *(
+                self._set_queue_policy(
+                    queue_name,
+                    [sub.topic_name for sub in desired.subscriptions if sub.queue_name == queue_name],
+                )
+                for queue_name in plan.set_queue_policies
+            )
+        )
+
+        await asyncio.gather(
+            *(self._subscribe(sub) for sub in plan.subscribe),
+            *(
+                self._update_filter_policy(arn, sub)
+                for arn, sub in plan.update_filter_policies
+            ),
+        )
+
+        return plan
+
+
+def _from_settings(setting: str) -> List[Any]:
+    queues = []
+    for type_name, kwargs in getattr(settings, setting, {}).values():
+        queues.append(import_type(type_name)(**kwargs))
+    return queues
+
+
+async def provision(
+    *, dry_run: bool = False, concurrency: int = DEFAULT_CONCURRENCY
+) -> List[TopologyPlan]:
+    """
+    Provision all queues, topics and subscriptions declared in the
+    ``SEND_MESSAGE_QUEUES`` and ``RECEIVE_MESSAGE_QUEUES`` settings.
+
+    Queues are grouped by AWS config/client arguments, each group is provisioned
+    using a shared set of clients.
+    """
+    groups = {}
+    for queue in _from_settings("SEND_MESSAGE_QUEUES") + _from_settings("RECEIVE_MESSAGE_QUEUES"):
+        # Provision the sender wrapped by an outbox
+        while isinstance(queue, OutboxSender):
+            queue = queue.sender
+        if isinstance(queue, (SQSBase, SNSSender)):
+            groups.setdefault(_client_key(queue), []).append(queue)
+
+    plans = []
+    for queues in groups.values():
+        async with TopologyProvisioner(
+            queues,
+            aws_config=queues[0].aws_config,
+            client_args=queues[0].client_args,
+            concurrency=concurrency,
+        ) as provisioner:
+            plan = await provisioner.plan()
+            LOGGER.info("Topology plan:\n%s", plan)
+            if not dry_run:
+                await provisioner.apply(plan)
+            plans.append(plan)
+
+    return plans
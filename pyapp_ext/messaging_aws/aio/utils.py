@@ -1,6 +1,117 @@
 """
 Common utils for interacting with AWS services
 """
+import json
+import logging
+import math
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import botocore.exceptions
+
+LOGGER = logging.getLogger(__name__)
+
+# Maximum delay supported natively by SQS
+MAX_DELAY_SECONDS = 900
+# Attribute holding the time (seconds since epoch) a delayed message is due
+DELIVER_AT_ATTRIBUTE = "DeliverAt"
+# Attribute holding the ID of the message a re-enqueued message is a copy of
+ORIGINAL_MESSAGE_ID_ATTRIBUTE = "OriginalMessageId"
+# Maximum number of message attributes supported by SQS
+MAX_MESSAGE_ATTRIBUTES = 10
+# Maximum size of a message (body and attributes) and of a batch request
+# supported by SQS and SNS
+MAX_MESSAGE_SIZE = 256 * 1024
+MAX_BATCH_BYTES = 256 * 1024
+
+# Error codes of send requests that can never succeed
+PERMANENT_ERROR_CODES = frozenset((
+    "AWS.SimpleQueueService.BatchRequestTooLong",
+    "BatchRequestTooLong",
+    "InvalidAttributeName",
+    "InvalidAttributeValue",
+    "InvalidMessageContents",
+    "InvalidParameter",
+    "InvalidParameterValue",
+    "ValidationError",
+))
+
+
+class RawMessage(NamedTuple):
+    """
+    Prepared and encoded message for sending in a batch
+    """
+
+    body: Union[str, bytes]
+    content_type: Optional[str] = None
+    content_encoding: Optional[str] = None
+    attributes: Optional[Dict[str, Any]] = None
+    deliver_at: Optional[float] = None
+
+
+class Rejected(NamedTuple):
+    """
+    Batch entry rejected due to a fault of the sender (eg an oversized body
+    or invalid attribute); the message will never be accepted so should not
+    be retried.
+    """
+
+    code: Optional[str]
+    message: Optional[str]
+
+
+def message_size(message: RawMessage) -> int:
+    """
+    Size of a message as counted against the SQS/SNS limits; the body and the
+    name, type and value of each attribute.
+    """
+    body = message.body
+    size = len(body.encode() if isinstance(body, str) else body)
+    attributes = build_attributes(
+        ContentType=message.content_type,
+        ContentEncoding=message.content_encoding,
+        DeliverAt=repr(message.deliver_at) if message.deliver_at is not None else None,
+        **(message.attributes or {}),
+    )
+    for name, value in attributes.items():
+        size += len(name.encode()) + len(value["DataType"]) + len(value["StringValue"].encode())
+    return size
+
+
+def permanent_error(ex: Exception) -> Optional[Rejected]:
+    """
+    Determine if an error raised by a send request is permanent (the request
+    can never succeed); returns :class:`Rejected` if so.
+    """
+    if isinstance(ex, botocore.exceptions.ParamValidationError):
+        return Rejected("ParamValidationError", str(ex))
+
+    if isinstance(ex, botocore.exceptions.ClientError):
+        error = ex.response.get("Error", {})
+        if error.get("Code") in PERMANENT_ERROR_CODES:
+            return Rejected(error.get("Code"), error.get("Message"))
+
+    return None
+
+
+def deferred_delivery(
+    deliver_at: Optional[float], now: float, *, native_delay: bool = True
+) -> Tuple[Optional[str], int]:
+    """
+    Determine how a message due at ``deliver_at`` is delivered; returns the
+    value of the ``DeliverAt`` attribute (None if not required) and the
+    native delay (in whole seconds, rounded up so a message is never early).
+
+    Without native delay support (ie SNS) the attribute is always used.
+    """
+    if deliver_at is None or deliver_at <= now:
+        return None, 0
+
+    remaining = deliver_at - now
+    if not native_delay:
+        return repr(deliver_at), 0
+
+    delay = min(math.ceil(remaining), MAX_DELAY_SECONDS)
+    return (repr(deliver_at) if remaining > MAX_DELAY_SECONDS else None), delay
 
 
 def build_attributes(**attrs):
@@ -9,7 +120,13 @@ def build_attributes(**attrs):
     """
     attributes = {}
     for key, value in attrs.items():
-        if value is not None:
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            attributes[key] = {"DataType": "String.Array", "StringValue": json.dumps(value)}
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            attributes[key] = {"DataType": "Number", "StringValue": str(value)}
+        else:
             attributes[key] = {"DataType": "String", "StringValue": value}
     return attributes
 
@@ -17,8 +134,76 @@ def build_attributes(**attrs):
 def parse_attributes(attributes):
     """
     Parse attributes structure
+
+    String and Number values are returned as strings, Binary values as bytes.
+    """
+    attrs = {}
+    for key, value in attributes.items():
+        if "StringValue" in value:
+            attrs[key] = value["StringValue"]
+        elif "BinaryValue" in value:
+            attrs[key] = value["BinaryValue"]
+    return attrs
+
+
+def parse_sns_attributes(attributes):
+    """
+    Parse attributes structure from an SNS notification envelope
+
+    Values are converted to their native type based on the attribute type.
     """
     attrs = {}
     for key, value in attributes.items():
-        attrs[key] = value["StringValue"]
+        data_type = value.get("Type", "String")
+        data = value.get("Value")
+        if data_type == "Number":
+            data = float(data)
+            if data.is_integer():
+                data = int(data)
+        elif data_type == "String.Array":
+            data = json.loads(data)
+        attrs[key] = data
     return attrs
+
+
+def parse_batch_response(response, count: int) -> List[Union[str, Rejected, None]]:
+    """
+    Parse a batch send response (entries are identified by index) into a list
+    of message IDs, failed entries are None or :class:`Rejected` if the
+    failure was a sender fault.
+    """
+    message_ids = [None] * count
+    for entry in response.get("Successful", ()):
+        message_ids[int(entry["Id"])] = entry["MessageId"]
+    for entry in response.get("Failed", ()):
+        LOGGER.warning(
+            "Failed to send message: %s (%s)", entry.get("Message"), entry.get("Code")
+        )
+        if entry.get("SenderFault"):
+            message_ids[int(entry["Id"])] = Rejected(entry.get("Code"), entry.get("Message"))
+    return message_ids
+
+
+def batch_entries(
+    messages: Sequence[RawMessage], body_field: str, *, now: float, native_delay: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Build batch request entries (identified by index)
+    """
+    entries = []
+    for idx, message in enumerate(messages):
+        deliver_at, delay = deferred_delivery(message.deliver_at, now, native_delay=native_delay)
+        entry = {
+            "Id": str(idx),
+            body_field: message.body,
+            "MessageAttributes": build_attributes(
+                ContentType=message.content_type,
+                ContentEncoding=message.content_encoding,
+                DeliverAt=deliver_at,
+                **(message.attributes or {}),
+            ),
+        }
+        if delay:
+            entry["DelaySeconds"] = delay
+        entries.append(entry)
+    return entries
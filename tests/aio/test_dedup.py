@@ -0,0 +1,175 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from pyapp_ext.messaging_aws.aio import dedup, sns
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestMemoryBackend:
+    @pytest.mark.asyncio
+    async def test_contains(self):
+        target = dedup.MemoryBackend()
+
+        await target.add("abc")
+
+        assert await target.contains("abc")
+        assert not await target.contains("def")
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self):
+        target = dedup.MemoryBackend(max_size=2)
+
+        await target.add("a")
+        await target.add("b")
+        await target.contains("a")
+        await target.add("c")
+
+        assert len(target) == 2
+        assert await target.contains("a")
+        assert not await target.contains("b")
+        assert await target.contains("c")
+
+    @pytest.mark.asyncio
+    async def test_ttl(self):
+        clock = Clock()
+        target = dedup.MemoryBackend(ttl=10, clock=clock)
+
+        await target.add("abc")
+        clock.now += 10
+
+        assert not await target.contains("abc")
+        assert len(target) == 0
+
+
+class TestSQLiteBackend:
+    @pytest.mark.asyncio
+    async def test_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / "dedup.sqlite")
+        target1 = dedup.SQLiteBackend(path)
+        target2 = dedup.SQLiteBackend(path)
+
+        await target1.add("abc")
+
+        assert await target2.contains("abc")
+        assert not await target2.contains("def")
+
+        await target1.close()
+        await target2.close()
+
+    @pytest.mark.asyncio
+    async def test_ttl(self, tmp_path):
+        clock = Clock()
+        target = dedup.SQLiteBackend(str(tmp_path / "dedup.sqlite"), ttl=10, clock=clock)
+
+        await target.add("abc")
+        clock.now += 10
+
+        assert not await target.contains("abc")
+
+        await target.close()
+
+
+    @pytest.mark.asyncio
+    async def test_concurrent_first_use(self, tmp_path):
+        target = dedup.SQLiteBackend(str(tmp_path / "dedup.sqlite"))
+
+        actual, _ = await asyncio.gather(target.contains("abc"), target.add("def"))
+
+        assert not actual
+        assert await target.contains("def")
+
+        await target.close()
+
+    @pytest.mark.asyncio
+    async def test_purge(self, tmp_path):
+        clock = Clock()
+        target = dedup.SQLiteBackend(
+            str(tmp_path / "dedup.sqlite"), ttl=10, purge_interval=30, clock=clock
+        )
+
+        await target.add("abc")
+        clock.now += 20
+        await target.add("def")
+        clock.now += 20
+        await target.add("ghi")
+
+        rows = await target._run(
+            lambda: target._connection.execute("SELECT key FROM processed_messages").fetchall()
+        )
+        assert rows == [("ghi",)]
+
+        await target.close()
+
+
+class TestDeduplicator:
+    @pytest.mark.asyncio
+    async def test_is_duplicate(self):
+        target = dedup.Deduplicator()
+        message = mock.Mock(message_id="abc", original_message_id=None, queue=None)
+
+        assert not await target.is_duplicate(message)
+        await target.mark(message)
+        assert await target.is_duplicate(message)
+
+    @pytest.mark.asyncio
+    async def test_is_duplicate__no_key(self):
+        target = dedup.Deduplicator(key=lambda message: None)
+        message = mock.Mock()
+
+        await target.mark(message)
+        assert not await target.is_duplicate(message)
+
+    @pytest.mark.asyncio
+    async def test_is_duplicate__shared_backend(self):
+        backend = dedup.MemoryBackend()
+        await backend.add("abc")
+        target = dedup.Deduplicator(backend, key=lambda message: message.body)
+
+        assert await target.is_duplicate(mock.Mock(body="abc", queue=None))
+        assert not await target.is_duplicate(mock.Mock(body="def", queue=None))
+
+    @pytest.mark.asyncio
+    async def test_mark__shared_backend(self):
+        backend = dedup.MemoryBackend()
+        target = dedup.Deduplicator(backend)
+
+        await target.mark(mock.Mock(message_id="abc", original_message_id=None, queue=None))
+
+        assert await backend.contains("abc")
+
+
+@pytest.mark.asyncio
+async def test_receivers_share_backend(tmp_path):
+    """
+    Copies of an SNS message delivered to different subscribed queues are not
+    duplicates of each other.
+    """
+    backend = dedup.SQLiteBackend(str(tmp_path / "dedup.sqlite"))
+    receivers = [
+        sns.SNSReceiver(
+            topic_name="my_topic", queue_name=queue_name, deduplicator=dedup.Deduplicator(backend)
+        )
+        for queue_name in ("queue1", "queue2")
+    ]
+    messages = [
+        sns.SNSMessage({"MessageId": "abc", "ReceiptHandle": "1", "Body": "SomeData"}, receiver)
+        for receiver in receivers
+    ]
+    for receiver in receivers:
+        receiver._client = mock.AsyncMock()
+
+    await receivers[0].delete(messages[0])
+
+    assert await receivers[0].deduplicator.is_duplicate(messages[0])
+    assert not await receivers[1].deduplicator.is_duplicate(messages[1])
+
+    await backend.close()
@@ -0,0 +1,80 @@
+import pytest
+
+from pyapp_ext.messaging_aws.aio import filters
+
+
+@pytest.mark.parametrize("policy, document, expected", (
+    ({}, {}, True),
+    ({"store": ["example_corp"]}, {"store": "example_corp"}, True),
+    ({"store": ["example_corp"]}, {"store": "other_corp"}, False),
+    ({"store": ["example_corp"]}, {}, False),
+    ({"store": ["a", "b"]}, {"store": "b"}, True),
+    ({"tags": ["a"]}, {"tags": ["b", "a"]}, True),
+    ({"price": [100]}, {"price": 100}, True),
+    ({"price": [100]}, {"price": "100"}, False),
+    ({"price": [{"numeric": [">", 0, "<=", 150]}]}, {"price": 150}, True),
+    ({"price": [{"numeric": [">", 0, "<=", 150]}]}, {"price": 151}, False),
+    ({"price": [{"numeric": ["=", 0]}]}, {"price": "0"}, False),
+    ({"event": [{"prefix": "order-"}]}, {"event": "order-placed"}, True),
+    ({"event": [{"suffix": "-placed"}]}, {"event": "order-placed"}, True),
+    ({"event": [{"equals-ignore-case": "ORDER"}]}, {"event": "order"}, True),
+    ({"event": [{"anything-but": ["a", "b"]}]}, {"event": "c"}, True),
+    ({"event": [{"anything-but": "a"}]}, {"event": "a"}, False),
+    ({"event": [{"anything-but": {"prefix": "order-"}}]}, {"event": "order-placed"}, False),
+    ({"event": [{"exists": True}]}, {"event": "a"}, True),
+    ({"event": [{"exists": True}]}, {}, False),
+    ({"event": [{"exists": False}]}, {}, True),
+    ({"event": [{"exists": False}]}, {"event": "a"}, False),
+    ({"a": ["x"], "b": ["y"]}, {"a": "x", "b": "z"}, False),
+    ({"$or": [{"a": ["x"]}, {"b": ["y"]}]}, {"b": "y"}, True),
+    ({"$or": [{"a": ["x"]}, {"b": ["y"]}]}, {"c": "y"}, False),
+    ({"order": {"type": ["retail"]}}, {"order": {"type": "retail"}}, True),
+    ({"order": {"type": ["retail"]}}, {"order": "retail"}, False),
+    ({"order": {"type": [{"exists": False}]}}, {}, True),
+    ({"order": {"type": [{"exists": True}]}}, {}, False),
+))
+def test_matches(policy, document, expected):
+    actual = filters.matches(policy, document)
+
+    assert actual is expected
+
+
+def test_matches__unsupported_operator():
+    with pytest.raises(ValueError):
+        filters.matches({"a": [{"cidr": "10.0.0.0/24"}]}, {"a": "10.0.0.1"})
+
+
+@pytest.mark.parametrize("policy", (
+    {"a": [{"cidr": "10.0.0.0/24"}]},
+    {"a": [{"anything-but": {"equals-ignore-case": "x"}}]},
+    {"a": [{"numeric": [">", "1"]}]},
+    {"a": [{"numeric": ["!=", 1]}]},
+    {"a": [{"prefix": "x", "suffix": "y"}]},
+    {"a": "x"},
+    {"$or": {"a": ["x"]}},
+    {"order": {"type": [{"cidr": "10.0.0.0/24"}]}},
+    ["a"],
+))
+def test_validate_policy__invalid(policy):
+    with pytest.raises(ValueError):
+        filters.validate_policy(policy)
+
+
+def test_validate_policy():
+    filters.validate_policy({
+        "a": ["x", 1, {"prefix": "x"}, {"anything-but": {"suffix": "y"}}, {"numeric": [">", 1]}],
+        "$or": [{"b": [{"exists": False}]}, {"c": {"d": [{"equals-ignore-case": "z"}]}}],
+    })
+
+
+@pytest.mark.parametrize("policy, scope, expected", (
+    (None, filters.SCOPE_MESSAGE_ATTRIBUTES, {}),
+    ({"a": ["x"]}, filters.SCOPE_MESSAGE_BODY, {
+        "FilterPolicyScope": "MessageBody",
+        "FilterPolicy": '{"a": ["x"]}',
+    }),
+))
+def test_subscription_attributes(policy, scope, expected):
+    actual = filters.subscription_attributes(policy, scope)
+
+    assert actual == expected
@@ -0,0 +1,400 @@
+import asyncio
+import os
+from unittest import mock
+
+import botocore.exceptions
+import pytest
+
+from pyapp_ext.messaging.exceptions import MessagingError
+from pyapp_ext.messaging_aws.aio import outbox
+from pyapp_ext.messaging_aws.aio.utils import RawMessage, Rejected
+
+
+@pytest.fixture
+def target(tmp_path):
+    target = outbox.Outbox(str(tmp_path / "outbox"), segment_size=256)
+    target.open()
+    yield target
+    target.close()
+
+
+def segment_files(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(outbox.SEGMENT_SUFFIX))
+
+
+@pytest.mark.parametrize("message", (
+    RawMessage("SomeData"),
+    RawMessage(b"SomeData", "application/json", "utf8", {"event": "a"}),
+))
+def test_encode_decode_record(message):
+    actual = outbox.decode_record(outbox.encode_record(message, 123.0))
+
+    assert actual == (123.0, message)
+
+
+class TestOutbox:
+    def test_init__invalid_fsync(self, tmp_path):
+        with pytest.raises(ValueError):
+            outbox.Outbox(str(tmp_path), fsync="sometimes")
+
+    def test_append_read_commit(self, target):
+        target.append(RawMessage("SomeData1"))
+        target.append(RawMessage(b"SomeData2", "application/json"))
+
+        actual = target.read(10)
+
+        assert [record.message for record in actual] == [
+            RawMessage("SomeData1"),
+            RawMessage(b"SomeData2", "application/json"),
+        ]
+        assert target.pending == 2
+
+        target.commit(actual[:1])
+
+        assert target.pending == 1
+        assert [record.message.body for record in target.read(10)] == [b"SomeData2"]
+
+    def test_append__too_large(self, target):
+        with pytest.raises(ValueError):
+            target.append(RawMessage("x" * 256))
+
+    def test_recovery(self, target):
+        target.append(RawMessage("SomeData1"))
+        target.append(RawMessage("SomeData2"))
+        target.commit(target.read(1))
+        target.close()
+
+        target.open()
+
+        assert target.pending == 1
+        assert target.read(10)[0].message.body == "SomeData2"
+
+    def test_recovery__torn_record(self, target):
+        target.append(RawMessage("SomeData1"))
+        offset = int(target.append(RawMessage("SomeData2")).split(":")[1])
+        target.close()
+
+        path = os.path.join(target.path, segment_files(target.path)[0])
+        with open(path, "r+b") as f:
+            f.seek(offset + outbox.HEADER.size + 4)
+            f.write(b"\xff")
+
+        target.open()
+
+        assert target.pending == 1
+        target.append(RawMessage("SomeData3"))
+        assert [record.message.body for record in target.read(10)] == ["SomeData1", "SomeData3"]
+
+    def test_segments_rolled_and_removed(self, target):
+        for idx in range(10):
+            target.append(RawMessage(f"SomeData{idx}" * 4))
+
+        assert len(segment_files(target.path)) > 1
+
+        while target.pending:
+            target.commit(target.read(3))
+
+        assert len(segment_files(target.path)) == 1
+        target.append(RawMessage("SomeData"))
+        assert [record.message.body for record in target.read(10)] == ["SomeData"]
+
+    def test_open__locked(self, target):
+        other = outbox.Outbox(target.path)
+
+        with pytest.raises(MessagingError):
+            other.open()
+
+        target.close()
+        other.open()
+        other.close()
+
+    def test_read__max_bytes(self, target):
+        for idx in range(3):
+            target.append(RawMessage(f"{idx}" * 50))
+
+        assert len(target.read(10, 120)) == 2
+        # At least one message is always read
+        assert len(target.read(10, 10)) == 1
+
+    def test_dead_letter(self, target):
+        target.append(RawMessage(b"SomeData1", "application/json"))
+        target.append(RawMessage("SomeData2"))
+        for record in target.read(10):
+            target.dead_letter(record)
+
+        actual = [message for _, message in target.dead_letters()]
+
+        assert actual == [RawMessage(b"SomeData1", "application/json"), RawMessage("SomeData2")]
+
+    def test_fsync_always(self, tmp_path):
+        target = outbox.Outbox(str(tmp_path), fsync=outbox.FSYNC_ALWAYS)
+        target.open()
+        with mock.patch.object(outbox.Outbox, "flush") as mock_flush:
+            target.append(RawMessage("SomeData"))
+
+        mock_flush.assert_called_once()
+        target.close()
+
+
+class TestOutboxSender:
+    @pytest.fixture
+    def sender(self):
+        return mock.AsyncMock(
+            send_raw_batch=mock.AsyncMock(
+                side_effect=lambda messages: [str(idx) for idx, _ in enumerate(messages)]
+            ),
+        )
+
+    @pytest.fixture
+    def target(self, tmp_path, sender):
+        target = outbox.OutboxSender(
+            sender=sender, path=str(tmp_path), retry_delay=0, poll_interval=60
+        )
+        target.outbox.open()
+        yield target
+        target.outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_send_raw(self, target, sender):
+        target._wakeup = mock.Mock()
+
+        actual = await target.send_raw(b"SomeData", content_type="application/json")
+
+        assert actual == "0:0"
+        target._wakeup.set.assert_called()
+        sender.send_raw_batch.assert_not_awaited()
+        assert target.metrics["pending"] == 1
+
+    @pytest.mark.asyncio
+    async def test_flush(self, target, sender):
+        target._wakeup = mock.Mock()
+        for idx in range(12):
+            await target.send_raw(f"SomeData{idx}")
+
+        await target.flush()
+
+        assert sender.send_raw_batch.await_count == 2
+        first_batch = sender.send_raw_batch.await_args_list[0].args[0]
+        assert [message.body for message in first_batch] == [f"SomeData{idx}" for idx in range(10)]
+        assert target.metrics["pending"] == 0
+        assert target.metrics["sent"] == 12
+
+    @pytest.mark.asyncio
+    async def test_flush__retry_failed(self, target, sender):
+        target._wakeup = mock.Mock()
+        sender.send_raw_batch.side_effect = [
+            Exception("Eek"),
+            ["a", None],
+            ["b"],
+        ]
+        await target.send_raw("SomeData1")
+        await target.send_raw("SomeData2")
+
+        await target.flush()
+
+        assert [call.args[0][-1].body for call in sender.send_raw_batch.await_args_list] == [
+            "SomeData2", "SomeData2", "SomeData2",
+        ]
+        assert len(sender.send_raw_batch.await_args_list[2].args[0]) == 1
+        assert target.metrics["retries"] == 2
+        assert target.metrics["last_error"] == "Eek"
+        assert target.metrics["pending"] == 0
+
+    @pytest.mark.asyncio
+    async def test_send_raw__not_open(self, tmp_path, sender):
+        target = outbox.OutboxSender(sender=sender, path=str(tmp_path))
+
+        with pytest.raises(MessagingError):
+            await target.send_raw("SomeData")
+
+    @pytest.mark.asyncio
+    async def test_send_raw__too_large(self, target, sender):
+        target._wakeup = mock.Mock()
+        target.max_message_size = 10
+
+        with pytest.raises(ValueError):
+            await target.send_raw("x" * 11)
+
+        assert target.outbox.pending == 0
+
+    @pytest.mark.asyncio
+    async def test_open__locked(self, tmp_path, sender):
+        other = outbox.Outbox(str(tmp_path))
+        other.open()
+        target = outbox.OutboxSender(sender=sender, path=str(tmp_path))
+
+        with pytest.raises(MessagingError):
+            await target.open()
+
+        sender.close.assert_awaited()
+        other.close()
+
+    @pytest.mark.asyncio
+    async def test_send_raw__fsync_always(self, tmp_path, sender):
+        target = outbox.OutboxSender(sender=sender, path=str(tmp_path), fsync=outbox.FSYNC_ALWAYS)
+        target.outbox.open()
+        target._wakeup = mock.Mock()
+
+        with mock.patch.object(outbox.Outbox, "flush") as mock_flush:
+            await target.send_raw("SomeData")
+
+        mock_flush.assert_called_once()
+        target.outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_flush__order_preserved(self, target, sender):
+        sent = []
+        failed = set()
+
+        def send_raw_batch(messages):
+            message_ids = []
+            for message in messages:
+                if message.body == "b" and "b" not in failed:
+                    failed.add("b")
+                    message_ids.append(None)
+                else:
+                    sent.append(message.body)
+                    message_ids.append(message.body)
+            return message_ids
+
+        sender.send_raw_batch.side_effect = send_raw_batch
+        target._wakeup = mock.Mock()
+        for body in "abcd":
+            await target.send_raw(body)
+
+        await target.flush()
+
+        # Messages following the failure are re-sent after it
+        assert sent == ["a", "c", "d", "b", "c", "d"]
+        assert target.metrics["sent"] == 4
+        assert target.metrics["pending"] == 0
+
+    @pytest.mark.asyncio
+    async def test_flush__rejected(self, target, sender):
+        sender.send_raw_batch.side_effect = [
+            ["a", Rejected("InvalidParameterValue", "Too big"), "c"],
+        ]
+        target._wakeup = mock.Mock()
+        for body in "abc":
+            await target.send_raw(body)
+
+        await target.flush()
+
+        assert sender.send_raw_batch.await_count == 1
+        assert [message.body for _, message in target.outbox.dead_letters()] == ["b"]
+        assert target.metrics["sent"] == 2
+        assert target.metrics["rejected"] == 1
+        assert target.metrics["pending"] == 0
+
+    @pytest.mark.asyncio
+    async def test_flush__permanent_request_error(self, target, sender):
+        def send_raw_batch(messages):
+            if any(message.body == "big" for message in messages):
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "BatchRequestTooLong", "Message": "Too long"}},
+                    "SendMessageBatch",
+                )
+            return [message.body for message in messages]
+
+        sender.send_raw_batch.side_effect = send_raw_batch
+        target._wakeup = mock.Mock()
+        for body in ("a", "big", "c"):
+            await target.send_raw(body)
+
+        await target.flush()
+
+        assert [message.body for _, message in target.outbox.dead_letters()] == ["big"]
+        assert [
+            [message.body for message in call.args[0]]
+            for call in sender.send_raw_batch.await_args_list
+        ] == [["a", "big", "c"], ["a"], ["big"], ["c"]]
+        assert target.metrics["sent"] == 2
+        assert target.metrics["rejected"] == 1
+        assert target.metrics["pending"] == 0
+
+    @pytest.mark.asyncio
+    async def test_flush__batch_bytes(self, target, sender):
+        target._wakeup = mock.Mock()
+        target.max_batch_bytes = 120
+        for idx in range(3):
+            await target.send_raw(f"{idx}" * 50)
+
+        await target.flush()
+
+        assert [len(call.args[0]) for call in sender.send_raw_batch.await_args_list] == [2, 1]
+
+    @pytest.mark.asyncio
+    async def test_drain__error_restarts(self, target, sender):
+        target.poll_interval = 0
+        target._wakeup = asyncio.Event()
+        await target.send_raw("SomeData")
+
+        with mock.patch.object(
+            outbox.Outbox, "read", side_effect=[OSError("Disk full"), *[[]] * 100]
+        ) as mock_read:
+            task = asyncio.ensure_future(target._drain())
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+            assert not task.done()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        assert mock_read.call_count > 1
+        assert target.metrics["last_error"] == "Disk full"
+
+    @pytest.mark.asyncio
+    async def test_flush__delay(self, target, sender):
+        target._wakeup = mock.Mock()
+        target.outbox.clock = mock.Mock(return_value=1000.0)
+        await target.send_raw("SomeData", delay=3600)
+
+        await target.flush()
+
+        message, = sender.send_raw_batch.await_args.args[0]
+        assert message.deliver_at == 4600.0
+
+    @pytest.mark.asyncio
+    async def test_flush__delay_without_batch(self, target):
+        target.sender = sender = mock.Mock(
+            spec=["send_raw"], send_raw=mock.AsyncMock(return_value="abc")
+        )
+        target._wakeup = mock.Mock()
+        target.outbox.clock = mock.Mock(return_value=1000.0)
+        await target.send_raw("SomeData", delay=3600)
+        target.outbox.clock.return_value = 1600.0
+
+        await target.flush()
+
+        sender.send_raw.assert_awaited_with(
+            "SomeData", content_type=None, content_encoding=None, delay=3000.0
+        )
+
+    @pytest.mark.asyncio
+    async def test_open_close(self, tmp_path, sender):
+        target = outbox.OutboxSender(sender=sender, path=str(tmp_path / "box"), poll_interval=60)
+
+        await target.open()
+        await target.send_raw("SomeData")
+        for _ in range(5):
+            # Allow the drainer to run
+            await asyncio.sleep(0)
+        await target.close()
+
+        sender.open.assert_awaited()
+        sender.close.assert_awaited()
+        sender.send_raw_batch.assert_awaited()
+
+    @pytest.mark.asyncio
+    async def test_drain(self, tmp_path, sender):
+        target = outbox.OutboxSender(sender=sender, path=str(tmp_path / "box"), poll_interval=60)
+        await target.open()
+        await target._stop_drainer()
+        await target.send_raw("SomeData")
+
+        await target.drain(timeout=5)
+
+        sender.send_raw_batch.assert_awaited_once()
+        sender.drain.assert_awaited()
+        assert target.outbox.pending == 0
@@ -1,3 +1,4 @@
+import json
 from unittest import mock
 
 import pytest
@@ -61,3 +62,197 @@ class TestSNSSender:
         mock_factory.assert_awaited_with("sns", "my_config")
         mock_client.create_topic.assert_awaited_with(Name="my_topic")
         mock_client.close.assert_called()
+
+
+    @pytest.mark.asyncio
+    async def test_send_raw__delay(self):
+        target = sns.SNSSender(topic_name="my_topic", clock=lambda: 1000)
+        target._topic_arn = "arn:sns:...:my_topic"
+        target._client = client = mock.AsyncMock(
+            publish=mock.AsyncMock(return_value={"MessageId": "abc"})
+        )
+
+        actual = await target.send_raw("SomeData", delay=60)
+
+        assert actual == "abc"
+        client.publish.assert_awaited_with(
+            TopicArn="arn:sns:...:my_topic",
+            Message="SomeData",
+            MessageAttributes={"DeliverAt": {"DataType": "String", "StringValue": "1060"}},
+        )
+
+class TestSNSReceiver:
+    def test_init__invalid_scope(self):
+        with pytest.raises(ValueError):
+            sns.SNSReceiver(topic_name="my_topic", filter_policy_scope="Eek")
+
+    def test_init__invalid_filter_policy(self):
+        with pytest.raises(ValueError):
+            sns.SNSReceiver(
+                topic_name="my_topic",
+                filter_policy={"event": [{"anything-but": {"equals-ignore-case": "a"}}]},
+                filter_locally=True,
+            )
+
+    def test_init__server_side_filter_policy(self):
+        filter_policy = {"source_ip": [{"cidr": "10.0.0.0/24"}]}
+
+        target = sns.SNSReceiver(topic_name="my_topic", filter_policy=filter_policy)
+
+        assert target.subscription_attributes["FilterPolicy"] == json.dumps(filter_policy)
+
+    @pytest.mark.parametrize("filter_policy, expected", (
+        (None, [("FilterPolicy", "{}")]),
+        ({"event": ["a"]}, [
+            ("FilterPolicyScope", "MessageAttributes"), ("FilterPolicy", '{"event": ["a"]}')
+        ]),
+    ))
+    @pytest.mark.asyncio
+    async def test_configure(self, monkeypatch, filter_policy, expected):
+        sns_client = mock.AsyncMock(
+            create_topic=mock.AsyncMock(return_value={"TopicArn": "arn:sns:...:my_topic"}),
+            subscribe=mock.AsyncMock(return_value={"SubscriptionArn": "arn:sub"}),
+        )
+        sqs_client = mock.AsyncMock(
+            create_queue=mock.AsyncMock(return_value={"QueueUrl": "http://example.com/my_queue"}),
+            get_queue_attributes=mock.AsyncMock(
+                return_value={"Attributes": {"QueueArn": "arn:sqs:...:my_queue"}}
+            ),
+        )
+
+        def create_client(service, *args, **kwargs):
+            context = mock.MagicMock()
+            context.__aenter__.return_value = {"sns": sns_client, "sqs": sqs_client}[service]
+            return context
+
+        monkeypatch.setattr(sns, "create_client", create_client)
+        target = sns.SNSReceiver(topic_name="my_topic", filter_policy=filter_policy)
+
+        actual = await target.configure()
+
+        assert actual == "arn:sub"
+        assert [
+            (call.kwargs["AttributeName"], call.kwargs["AttributeValue"])
+            for call in sns_client.set_subscription_attributes.await_args_list
+        ] == expected
+
+    @pytest.mark.parametrize("kwargs, message, attrs, expected", (
+        ({}, "{}", {}, True),
+        ({"filter_policy": {"event": ["a"]}}, "{}", {}, True),
+        ({"filter_policy": {"event": ["a"]}, "filter_locally": True}, "{}", {
+            "event": {"Type": "String", "Value": "a"}
+        }, True),
+        ({"filter_policy": {"event": ["a"]}, "filter_locally": True}, "{}", {
+            "event": {"Type": "String", "Value": "b"}
+        }, False),
+        ({
+            "filter_policy": {"event": ["a"]},
+            "filter_policy_scope": "MessageBody",
+            "filter_locally": True,
+        }, '{"event": "a"}', {}, True),
+        ({
+            "filter_policy": {"event": ["a"]},
+            "filter_policy_scope": "MessageBody",
+            "filter_locally": True,
+        }, "not-json", {}, False),
+    ))
+    def test_filter_message(self, kwargs, message, attrs, expected):
+        target = sns.SNSReceiver(topic_name="my_topic", **kwargs)
+
+        sqs_message = sns.SQSMessage({"MessageId": "abc", "ReceiptHandle": "1"}, target)
+        actual = target.filter_message(sns.SNSMessage.from_notification(
+            sqs_message, {"Message": message, "MessageAttributes": attrs}
+        ))
+
+        assert actual is expected
+
+    @pytest.mark.asyncio
+    async def test_receive_raw__filtered(self):
+        target = sns.SNSReceiver(
+            topic_name="my_topic", filter_policy={"event": ["a"]}, filter_locally=True
+        )
+        target._client = client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(
+                return_value={
+                    "Messages": [
+                        {
+                            "ReceiptHandle": "1",
+                            "Body": json.dumps({
+                                "Message": "SomeData1",
+                                "MessageAttributes": {"event": {"Type": "String", "Value": "b"}},
+                            }),
+                        },
+                        {
+                            "ReceiptHandle": "2",
+                            "Body": json.dumps({
+                                "Message": "SomeData2",
+                                "MessageAttributes": {"event": {"Type": "String", "Value": "a"}},
+                            }),
+                        },
+                    ]
+                }
+            )
+        )
+
+        async for message in target.receive_raw():
+            break
+
+        assert message.body == "SomeData2"
+        client.delete_message.assert_awaited_once_with(QueueUrl=None, ReceiptHandle="1")
+
+    @pytest.mark.asyncio
+    async def test_receive_raw(self):
+        target = sns.SNSReceiver(topic_name="my_topic")
+        target._client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(
+                return_value={
+                    "Messages": [
+                        {
+                            "MessageId": "abc",
+                            "ReceiptHandle": "1",
+                            "MD5OfBody": "...",
+                            "Body": json.dumps({
+                                "Type": "Notification",
+                                "MessageId": "sns-abc",
+                                "Message": '{"foo": "bar"}',
+                                "MessageAttributes": {
+                                    "ContentType": {"Type": "String", "Value": "application/json"}
+                                },
+                            }),
+                        },
+                    ]
+                }
+            )
+        )
+
+        async for actual in target.receive_raw():
+            break
+
+        assert isinstance(actual, sns.SNSMessage)
+        assert actual.body == '{"foo": "bar"}'
+        assert actual.content_type == "application/json"
+        assert actual.message_id == "sns-abc"
+        assert actual.envelope == {"MessageId": "sns-abc", "ReceiptHandle": "1"}
+        assert actual.queue is target
+
+    @pytest.mark.asyncio
+    async def test_receive_raw__not_sns_message(self, monkeypatch):
+        mock_handler = mock.AsyncMock()
+        monkeypatch.setattr(sns.SNSReceiver, "handle_invalid_message", mock_handler)
+        target = sns.SNSReceiver(topic_name="my_topic")
+        target._client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(
+                return_value={
+                    "Messages": [
+                        {"ReceiptHandle": "1", "Body": "not-json"},
+                        {"ReceiptHandle": "2", "Body": json.dumps({"Message": "SomeData"})},
+                    ]
+                }
+            )
+        )
+
+        async for actual in target.receive_raw():
+            break
+
+        assert actual.body == "SomeData"
+        mock_handler.assert_awaited_once()
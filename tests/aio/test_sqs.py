@@ -1,10 +1,12 @@
+import asyncio
 from unittest import mock
 
 import pytest
 import botocore.exceptions
 
-from pyapp_ext.messaging.exceptions import ClientError
+from pyapp_ext.messaging.exceptions import ClientError, MessagingError
 from pyapp_ext.messaging_aws.aio import sqs
+from pyapp_ext.messaging_aws.aio.utils import RawMessage
 
 
 class TestSQSBase:
@@ -205,6 +207,37 @@ class TestSQSSender:
             }
         )
 
+    @pytest.mark.asyncio
+    async def test_send_raw_batch(self):
+        target = sqs.SQSSender(queue_name="my_queue", aws_config="my_config")
+        target._queue_url = "http://example.com/my_queue"
+        target._client = client = mock.AsyncMock(
+            send_message_batch=mock.AsyncMock(return_value={
+                "Successful": [{"Id": "1", "MessageId": "abc"}],
+                "Failed": [{"Id": "0", "Code": "Eek", "Message": "Eek!"}],
+            })
+        )
+
+        actual = await target.send_raw_batch([
+            sqs.RawMessage(b"SomeData1"),
+            sqs.RawMessage(b"SomeData2", "application/json"),
+        ])
+
+        assert actual == [None, "abc"]
+        client.send_message_batch.assert_awaited_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[
+                {"Id": "0", "MessageBody": b"SomeData1", "MessageAttributes": {}},
+                {
+                    "Id": "1",
+                    "MessageBody": b"SomeData2",
+                    "MessageAttributes": {
+                        "ContentType": {"DataType": "String", "StringValue": "application/json"}
+                    },
+                },
+            ],
+        )
+
 
 class TestSQSReceiver:
     @pytest.mark.asyncio
@@ -252,3 +285,484 @@ class TestSQSReceiver:
         assert actual2.queue is target
         assert actual2.content_type == "application/json"
         assert actual2.content_encoding is None
+
+    @pytest.mark.asyncio
+    async def test_receive_raw__duplicates(self):
+        target = sqs.SQSReceiver(
+            queue_name="my_queue", aws_config="my_config", deduplicator=sqs.Deduplicator()
+        )
+        target._queue_url = "http://example.com/my_queue"
+        target._client = client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(
+                return_value={
+                    "Messages": [
+                        {"MessageId": "a", "ReceiptHandle": "1", "Body": b"SomeData1"},
+                        {"MessageId": "b", "ReceiptHandle": "2", "Body": b"SomeData2"},
+                    ]
+                }
+            ),
+            delete_message_batch=mock.AsyncMock(return_value={"Successful": [{"Id": "0"}]}),
+        )
+
+        # First message was processed (deleted) previously
+        await target.delete(sqs.SQSMessage({"MessageId": "a", "ReceiptHandle": "0"}, target))
+
+        async for message in target.receive_raw():
+            break
+
+        assert message.body == b"SomeData2"
+        client.delete_message_batch.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[{"Id": "0", "ReceiptHandle": "1"}],
+        )
+
+    @pytest.mark.asyncio
+    async def test_delete_batch(self):
+        target = sqs.SQSReceiver(queue_name="my_queue", aws_config="my_config")
+        target._queue_url = "http://example.com/my_queue"
+        target._client = client = mock.AsyncMock(
+            delete_message_batch=mock.AsyncMock(return_value={
+                "Failed": [{"Id": "0", "Message": "Eek"}]
+            }),
+        )
+        messages = [sqs.SQSMessage({"ReceiptHandle": str(idx)}, target) for idx in range(12)]
+
+        await target.delete_batch(messages)
+
+        assert client.delete_message_batch.await_count == 2
+        assert len(client.delete_message_batch.await_args.kwargs["Entries"]) == 2
+
+
+class TestSQSReceiverClose:
+    @pytest.mark.asyncio
+    async def test_close__deduplicator(self):
+        deduplicator = mock.AsyncMock()
+        target = sqs.SQSReceiver(queue_name="my_queue", deduplicator=deduplicator)
+        target._client = client = mock.AsyncMock()
+
+        await target.drain(timeout=0)
+
+        client.close.assert_awaited()
+        deduplicator.close.assert_awaited()
+
+
+class TestSQSReceiverVisibilityTimeout:
+    @pytest.mark.asyncio
+    async def test_open__queue_visibility_timeout(self, monkeypatch):
+        mock_client = mock.AsyncMock(
+            get_queue_url=mock.AsyncMock(return_value={"QueueUrl": "http://example.com/my_queue"}),
+            get_queue_attributes=mock.AsyncMock(
+                return_value={"Attributes": {"VisibilityTimeout": "120"}}
+            ),
+        )
+        monkeypatch.setattr(sqs, "aio_create_client", mock.AsyncMock(return_value=mock_client))
+        target = sqs.SQSReceiver(queue_name="my_queue")
+
+        await target.open()
+
+        mock_client.get_queue_attributes.assert_awaited_with(
+            QueueUrl="http://example.com/my_queue", AttributeNames=["VisibilityTimeout"]
+        )
+        assert target._visibility_timeout == 120
+
+    @pytest.mark.asyncio
+    async def test_open__visibility_timeout_client_error(self, monkeypatch):
+        mock_client = mock.AsyncMock(
+            get_queue_url=mock.AsyncMock(return_value={"QueueUrl": "http://example.com/my_queue"}),
+            get_queue_attributes=mock.AsyncMock(side_effect=botocore.exceptions.ClientError(
+                {"Error": {"Code": "AccessDenied"}}, "GetQueueAttributes"
+            )),
+        )
+        monkeypatch.setattr(sqs, "aio_create_client", mock.AsyncMock(return_value=mock_client))
+        target = sqs.SQSReceiver(queue_name="my_queue")
+
+        with pytest.raises(ClientError):
+            await target.open()
+
+        mock_client.close.assert_awaited()
+        assert target._client is None
+
+    @pytest.mark.asyncio
+    async def test_receive_raw__visibility_timeout(self):
+        target = sqs.SQSReceiver(queue_name="my_queue", visibility_timeout=60)
+        target._client = client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(return_value={"Messages": [{"Body": b"SomeData"}]})
+        )
+
+        await target.receive_raw().__anext__()
+
+        assert client.receive_message.await_args.kwargs["VisibilityTimeout"] == 60
+        assert target._visibility_timeout == 60
+
+
+class TestSQSReceiverDrain:
+    @pytest.fixture
+    def target(self):
+        target = sqs.SQSReceiver(queue_name="my_queue", aws_config="my_config")
+        target._queue_url = "http://example.com/my_queue"
+        target._client = mock.AsyncMock(
+            receive_message=mock.AsyncMock(return_value={
+                "Messages": [
+                    {"MessageId": "a", "ReceiptHandle": "1", "Body": b"SomeData1"},
+                    {"MessageId": "b", "ReceiptHandle": "2", "Body": b"SomeData2"},
+                ]
+            }),
+            change_message_visibility_batch=mock.AsyncMock(return_value={}),
+        )
+        return target
+
+    @pytest.mark.asyncio
+    async def test_drain__release_in_flight(self, target):
+        client = target._client
+        receiver = target.receive_raw()
+        message = await receiver.__anext__()
+
+        await target.drain(timeout=0)
+
+        # Remaining message is not returned
+        with pytest.raises(StopAsyncIteration):
+            await receiver.__anext__()
+
+        client.change_message_visibility_batch.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[
+                {"Id": "0", "ReceiptHandle": "2", "VisibilityTimeout": 0},
+                {"Id": "1", "ReceiptHandle": "1", "VisibilityTimeout": 0},
+            ],
+        )
+        assert message.body == b"SomeData1"
+        assert target.in_flight == 0
+        client.close.assert_awaited()
+        assert target._client is None
+
+    @pytest.mark.asyncio
+    async def test_drain__in_flight_processed(self, target):
+        client = target._client
+        message = await target.receive_raw().__anext__()
+        assert target.in_flight == 1
+
+        async def process():
+            await asyncio.sleep(0.05)
+            await target.delete(message)
+
+        await asyncio.gather(target.drain(timeout=5), process())
+
+        client.delete_message.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue", ReceiptHandle="1"
+        )
+        # Only the message that was never returned is released
+        client.change_message_visibility_batch.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[{"Id": "0", "ReceiptHandle": "2", "VisibilityTimeout": 0}],
+        )
+
+    @pytest.mark.asyncio
+    async def test_drain__failed_handler_expired(self, target):
+        client = target._client
+        await target.receive_raw().__anext__()
+        # Handler failed and the visibility timeout of the message has expired
+        receipt_handle, (received, message) = target._in_flight.popitem()
+        target._in_flight[receipt_handle] = (received - target._visibility_timeout, message)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+
+        await target.drain(timeout=5)
+
+        assert loop.time() - start < 1
+        client.change_message_visibility_batch.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[{"Id": "0", "ReceiptHandle": "2", "VisibilityTimeout": 0}],
+        )
+
+    @pytest.mark.asyncio
+    async def test_drain__release_within_timeout(self, target):
+        client = target._client
+        await target.receive_raw().__anext__()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+
+        await target.drain(timeout=0.5)
+
+        assert loop.time() - start < 0.5
+        client.change_message_visibility_batch.assert_awaited_once()
+        client.close.assert_awaited()
+
+    @pytest.mark.asyncio
+    async def test_delete__after_drain(self, target):
+        message = await target.receive_raw().__anext__()
+        await target.drain(timeout=0)
+
+        with pytest.raises(MessagingError):
+            await target.delete(message)
+        with pytest.raises(MessagingError):
+            await target.delete_batch([message])
+
+    @pytest.mark.asyncio
+    async def test_drain__during_poll(self, target):
+        client = target._client
+        poll_started = asyncio.Event()
+        complete_poll = asyncio.Event()
+        response = client.receive_message.return_value
+
+        async def receive_message(**kwargs):
+            poll_started.set()
+            await complete_poll.wait()
+            return response
+
+        client.receive_message.side_effect = receive_message
+
+        async def consume():
+            return [message async for message in target.receive_raw()]
+
+        consumer = asyncio.ensure_future(consume())
+        await poll_started.wait()
+        drain = asyncio.ensure_future(target.drain(timeout=5))
+        await asyncio.sleep(0)
+        complete_poll.set()
+        await drain
+
+        assert await consumer == []
+        client.receive_message.assert_awaited_once()
+        client.change_message_visibility_batch.assert_awaited_once_with(
+            QueueUrl="http://example.com/my_queue",
+            Entries=[
+                {"Id": "0", "ReceiptHandle": "1", "VisibilityTimeout": 0},
+                {"Id": "1", "ReceiptHandle": "2", "VisibilityTimeout": 0},
+            ],
+        )
+
+
+class TestSQSMessage:
+    def test_lazy_fields(self, monkeypatch):
+        mock_parse = mock.Mock(return_value={"ContentType": "application/json"})
+        monkeypatch.setattr(sqs, "parse_attributes", mock_parse)
+        msg = {
+            "MessageId": "abc",
+            "ReceiptHandle": "def",
+            "MD5OfBody": "...",
+            "Body": '{"foo": "bar"}',
+            "MessageAttributes": {
+                "ContentType": {"DataType": "String", "StringValue": "application/json"}
+            },
+        }
+
+        target = sqs.SQSMessage(msg, None)
+
+        mock_parse.assert_not_called()
+        assert target.body is msg["Body"]
+        assert target.content_type == "application/json"
+        assert target.content_encoding is None
+        mock_parse.assert_called_once()
+        assert target.envelope == {"MessageId": "abc", "ReceiptHandle": "def"}
+        assert bytes(target.body_view) == b'{"foo": "bar"}'
+        assert not hasattr(target, "__dict__")
+
+    def test_binary_attribute(self):
+        target = sqs.SQSMessage({"MessageAttributes": {
+            "ContentType": {"DataType": "String", "StringValue": "application/json"},
+            "Blob": {"DataType": "Binary", "BinaryValue": b"xx"},
+        }}, None)
+
+        assert target.content_type == "application/json"
+        assert target.attributes["Blob"] == b"xx"
+
+    def test_body_view__str_cached(self):
+        target = sqs.SQSMessage({"Body": "SomeData"}, None)
+
+        actual = target.body_view
+
+        assert bytes(actual) == b"SomeData"
+        assert target.body_view.obj is actual.obj
+
+    def test_get_attribute(self):
+        target = sqs.SQSMessage({"MessageAttributes": {
+            "ContentType": {"DataType": "String", "StringValue": "application/json"},
+            "DeliverAt": {"DataType": "String", "StringValue": "1000.5"},
+        }}, None)
+
+        assert sqs.SQSReceiver._deliver_at(target) == 1000.5
+        assert target.get_attribute("Missing") is None
+        # Attributes are not all parsed
+        assert target._attributes is None
+        assert target.attributes["ContentType"] == "application/json"
+        assert target.get_attribute("DeliverAt") == "1000.5"
+
+    def test_body_view__bytes(self):
+        target = sqs.SQSMessage({"Body": b"SomeData"}, None)
+
+        actual = target.body_view
+
+        assert actual.obj is target.body
+
+
+class SimulatedClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeQueue:
+    """
+    In-memory SQS queue driven by a simulated clock; a long-poll with no
+    visible messages advances the clock.
+    """
+
+    def __init__(self, clock, visibility_timeout=30, batch_size=10):
+        self.clock = clock
+        self.visibility_timeout = visibility_timeout
+        self.batch_size = batch_size
+        self.messages = {}
+        self.sent = 0
+
+    def _send(self, body, attributes, delay):
+        assert 0 <= delay <= 900
+        self.sent += 1
+        receipt_handle = f"r{self.sent}"
+        self.messages[receipt_handle] = {
+            "MessageId": f"m{self.sent}",
+            "ReceiptHandle": receipt_handle,
+            "Body": body,
+            "MessageAttributes": attributes,
+            "visible_at": self.clock() + delay,
+        }
+        return f"m{self.sent}"
+
+    async def send_message(self, QueueUrl, MessageBody, MessageAttributes, DelaySeconds=0):
+        return {"MessageId": self._send(MessageBody, MessageAttributes, DelaySeconds)}
+
+    async def send_message_batch(self, QueueUrl, Entries):
+        return {"Successful": [
+            {
+                "Id": entry["Id"],
+                "MessageId": self._send(
+                    entry["MessageBody"], entry["MessageAttributes"], entry.get("DelaySeconds", 0)
+                ),
+            }
+            for entry in Entries
+        ]}
+
+    async def receive_message(self, QueueUrl, WaitTimeSeconds, MessageAttributeNames):
+        now = self.clock()
+        visible = [msg for msg in self.messages.values() if msg["visible_at"] <= now][:self.batch_size]
+        if not visible:
+            next_visible = min((msg["visible_at"] for msg in self.messages.values()), default=None)
+            self.clock.now = now + WaitTimeSeconds
+            if next_visible is not None:
+                self.clock.now = min(self.clock.now, next_visible)
+            return {}
+
+        for msg in visible:
+            msg["visible_at"] = now + self.visibility_timeout
+        return {"Messages": [
+            {
+                "MessageId": msg["MessageId"],
+                "ReceiptHandle": msg["ReceiptHandle"],
+                "Body": msg["Body"],
+                "MessageAttributes": {
+                    key: value for key, value in msg["MessageAttributes"].items()
+                    if "All" in MessageAttributeNames or key in MessageAttributeNames
+                },
+            }
+            for msg in visible
+        ]}
+
+    async def delete_message(self, QueueUrl, ReceiptHandle):
+        del self.messages[ReceiptHandle]
+
+    async def delete_message_batch(self, QueueUrl, Entries):
+        for entry in Entries:
+            del self.messages[entry["ReceiptHandle"]]
+        return {}
+
+
+class TestDelayedDelivery:
+    @pytest.mark.parametrize("delay, expected_hops", (
+        (None, 0),
+        (60, 0),
+        (900, 0),
+        (901.5, 1),
+        (3600, 3),
+        (86400, 95),
+    ))
+    @pytest.mark.asyncio
+    async def test_delivery_time(self, delay, expected_hops):
+        clock = SimulatedClock(1000.25)
+        queue = FakeQueue(clock)
+        sender = sqs.SQSSender(queue_name="my_queue", clock=clock)
+        sender._client = queue
+        receiver = sqs.SQSReceiver(queue_name="my_queue", wait_time=20, clock=clock)
+        receiver._client = queue
+
+        await sender.send_raw("SomeData", delay=delay)
+        async for message in receiver.receive_raw():
+            break
+
+        due = 1000.25 + (delay or 0)
+        assert message.body == "SomeData"
+        assert due <= clock.now < due + 1
+        # Initial send plus re-enqueue hops
+        assert queue.sent == expected_hops + 1
+        assert len(queue.messages) == 1
+
+    @pytest.mark.asyncio
+    async def test_reenqueue__attributes_preserved(self):
+        clock = SimulatedClock(1000.0)
+        queue = FakeQueue(clock, batch_size=1)
+        sender = sqs.SQSSender(queue_name="my_queue", clock=clock)
+        sender._client = queue
+        receiver = sqs.SQSReceiver(
+            queue_name="my_queue", clock=clock, deduplicator=sqs.Deduplicator()
+        )
+        receiver._client = queue
+
+        await sender.send_raw_batch([
+            RawMessage("SomeData", attributes={"event": "a"}, deliver_at=3000.0),
+        ])
+        # Duplicate delivery of the original message
+        queue.messages["dup"] = dict(queue.messages["r1"], ReceiptHandle="dup")
+        async for message in receiver.receive_raw():
+            break
+
+        assert message.attributes["event"] == "a"
+        assert message.message_id != "m1"
+        assert message.original_message_id == "m1"
+
+        # Copy of the duplicate is deleted once the first has been processed
+        await receiver.delete(message)
+        queue._send("SomeData2", {}, 900)
+        async for message in receiver.receive_raw():
+            break
+
+        assert message.body == "SomeData2"
+        assert len(queue.messages) == 1
+
+    @pytest.mark.asyncio
+    async def test_send_raw__native_delay(self):
+        target = sqs.SQSSender(queue_name="my_queue", clock=SimulatedClock(1000))
+        target._client = client = mock.AsyncMock(
+            send_message=mock.AsyncMock(return_value={"MessageId": "abc"})
+        )
+
+        await target.send_raw("SomeData", delay=10.5)
+
+        client.send_message.assert_awaited_with(
+            QueueUrl=None, MessageBody="SomeData", MessageAttributes={}, DelaySeconds=11
+        )
+
+    @pytest.mark.asyncio
+    async def test_send_raw__extended_delay(self):
+        target = sqs.SQSSender(queue_name="my_queue", clock=SimulatedClock(1000))
+        target._client = client = mock.AsyncMock(
+            send_message=mock.AsyncMock(return_value={"MessageId": "abc"})
+        )
+
+        await target.send_raw("SomeData", delay=3600)
+
+        client.send_message.assert_awaited_with(
+            QueueUrl=None,
+            MessageBody="SomeData",
+            MessageAttributes={"DeliverAt": {"DataType": "String", "StringValue": "4600"}},
+            DelaySeconds=900,
+        )
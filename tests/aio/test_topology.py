@@ -0,0 +1,203 @@
+import json
+from unittest import mock
+
+import pytest
+
+from pyapp_ext.messaging_aws.aio import outbox, topology, sqs, sns
+
+QUEUE_URL = "http://example.com/123/{}"
+QUEUE_ARN = "arn:aws:sqs:ap-southeast-2:123:{}"
+TOPIC_ARN = "arn:aws:sns:ap-southeast-2:123:{}"
+
+
+def queue_attributes(QueueUrl, AttributeNames):
+    return {"Attributes": {"QueueArn": QUEUE_ARN.format(QueueUrl.rsplit("/", 1)[-1])}}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    sqs_client = mock.AsyncMock(
+        list_queues=mock.AsyncMock(return_value={}),
+        create_queue=mock.AsyncMock(
+            side_effect=lambda QueueName: {"QueueUrl": QUEUE_URL.format(QueueName)}
+        ),
+        get_queue_attributes=mock.AsyncMock(side_effect=queue_attributes),
+    )
+    sns_client = mock.AsyncMock(
+        list_topics=mock.AsyncMock(return_value={}),
+        create_topic=mock.AsyncMock(
+            side_effect=lambda Name: {"TopicArn": TOPIC_ARN.format(Name)}
+        ),
+        subscribe=mock.AsyncMock(return_value={"SubscriptionArn": "arn:sub"}),
+    )
+    mock_factory = mock.AsyncMock(
+        side_effect=lambda service, *args, **kwargs: {"sqs": sqs_client, "sns": sns_client}[service]
+    )
+    monkeypatch.setattr(topology, "aio_create_client", mock_factory)
+    return sqs_client, sns_client
+
+
+@pytest.fixture
+def target():
+    return topology.TopologyProvisioner([
+        sqs.SQSSender(queue_name="queue1"),
+        sqs.SQSReceiver(queue_name="queue1"),
+        sns.SNSSender(topic_name="topic1"),
+        sns.SNSReceiver(topic_name="topic1", queue_name="queue2"),
+    ])
+
+
+def test_queue_policy():
+    actual = topology.queue_policy(QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")])
+
+    statement, = actual["Statement"]
+    assert statement["Resource"] == QUEUE_ARN.format("queue2")
+    assert statement["Condition"]["ArnEquals"]["aws:SourceArn"] == TOPIC_ARN.format("topic1")
+
+
+@pytest.mark.parametrize("policy, expected", (
+    (None, False),
+    ("", False),
+    ("not-json", False),
+    (json.dumps(topology.queue_policy(QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")])), True),
+    (json.dumps(topology.queue_policy(QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic2")])), False),
+    # Single statement object
+    (json.dumps({"Statement": topology.queue_policy(
+        QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")]
+    )["Statement"][0]}), True),
+    # Console generated ArnLike condition
+    (json.dumps({"Statement": [{
+        "Effect": "Allow",
+        "Principal": {"Service": "sns.amazonaws.com"},
+        "Action": "SQS:SendMessage",
+        "Resource": QUEUE_ARN.format("queue2"),
+        "Condition": {"ArnLike": {"aws:SourceArn": TOPIC_ARN.format("topic*")}},
+    }]}), True),
+))
+def test_policy_allows(policy, expected):
+    actual = topology._policy_allows(policy, QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")])
+
+    assert actual is expected
+
+
+def test_merge_queue_policy():
+    existing = {
+        "Version": "2012-10-17",
+        "Statement": {
+            "Sid": "s3-events",
+            "Effect": "Allow",
+            "Principal": {"Service": "s3.amazonaws.com"},
+            "Action": "sqs:SendMessage",
+            "Resource": QUEUE_ARN.format("queue2"),
+        },
+    }
+
+    actual = topology.merge_queue_policy(
+        json.dumps(existing), QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")]
+    )
+
+    assert [statement["Sid"] for statement in actual["Statement"]] == ["s3-events", "sns-topic1"]
+    assert topology._policy_allows(
+        json.dumps(actual), QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")]
+    )
+
+
+def test_merge_queue_policy__already_allowed():
+    existing = topology.queue_policy(QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")])
+
+    actual = topology.merge_queue_policy(
+        json.dumps(existing),
+        QUEUE_ARN.format("queue2"),
+        [TOPIC_ARN.format("topic1"), TOPIC_ARN.format("topic2")],
+    )
+
+    assert [statement["Sid"] for statement in actual["Statement"]] == ["sns-topic1", "sns-topic2"]
+
+
+@pytest.mark.asyncio
+async def test_provision__outbox(monkeypatch, tmp_path, clients):
+    queues = [outbox.OutboxSender(sender=sqs.SQSSender(queue_name="queue1"), path=str(tmp_path))]
+    monkeypatch.setattr(topology, "_from_settings", lambda setting: queues if "SEND" in setting else [])
+
+    actual, = await topology.provision(dry_run=True)
+
+    assert actual.create_queues == ("queue1",)
+
+
+class TestTopologyProvisioner:
+    def test_desired(self, target):
+        actual = target.desired()
+
+        assert actual.queues == {"queue1", "queue2"}
+        assert actual.topics == {"topic1"}
+        assert actual.subscriptions == (topology.Subscription("topic1", "queue2"),)
+
+    @pytest.mark.asyncio
+    async def test_plan__nothing_exists(self, clients, target):
+        async with target:
+            actual = await target.plan()
+
+        assert actual == topology.TopologyPlan(
+            ("topic1",),
+            ("queue1", "queue2"),
+            ("queue2",),
+            (topology.Subscription("topic1", "queue2"),),
+            (),
+        )
+
+    @pytest.mark.asyncio
+    async def test_plan__everything_exists(self, clients, target):
+        sqs_client, sns_client = clients
+        sqs_client.list_queues.side_effect = [
+            {"QueueUrls": [QUEUE_URL.format("queue1")], "NextToken": "abc"},
+            {"QueueUrls": [QUEUE_URL.format("queue2")]},
+        ]
+        sqs_client.get_queue_attributes.side_effect = None
+        sqs_client.get_queue_attributes.return_value = {"Attributes": {
+            "QueueArn": QUEUE_ARN.format("queue2"),
+            "Policy": json.dumps(topology.queue_policy(
+                QUEUE_ARN.format("queue2"), [TOPIC_ARN.format("topic1")]
+            )),
+        }}
+        sns_client.list_topics.return_value = {"Topics": [{"TopicArn": TOPIC_ARN.format("topic1")}]}
+        sns_client.list_subscriptions_by_topic.return_value = {"Subscriptions": [
+            {
+                "SubscriptionArn": "arn:sub",
+                "Protocol": "sqs",
+                "Endpoint": QUEUE_ARN.format("queue2"),
+            },
+            # Subscription of a queue not managed by this app
+            {
+                "SubscriptionArn": "arn:other",
+                "Protocol": "sqs",
+                "Endpoint": QUEUE_ARN.format("other"),
+            },
+        ]}
+        sns_client.get_subscription_attributes.return_value = {"Attributes": {}}
+
+        async with target:
+            actual = await target.plan()
+
+        assert not actual
+        assert str(actual) == "No changes"
+        sqs_client.list_queues.assert_awaited_with(MaxResults=1000, NextToken="abc")
+        sns_client.get_subscription_attributes.assert_awaited_once_with(SubscriptionArn="arn:sub")
+
+    @pytest.mark.asyncio
+    async def test_apply(self, clients, target):
+        sqs_client, sns_client = clients
+
+        async with target:
+            await target.apply()
+
+        assert sns_client.create_topic.await_count == 1
+        assert sqs_client.create_queue.await_count == 2
+        sqs_client.set_queue_attributes.assert_awaited_once()
+        sns_client.subscribe.assert_awaited_once_with(
+            TopicArn=TOPIC_ARN.format("topic1"),
+            Endpoint=QUEUE_ARN.format("queue2"),
+            Protocol="sqs",
+            ReturnSubscriptionArn=True,
+        )
+        sqs_client.close.assert_awaited()
+        sns_client.close.assert_awaited()
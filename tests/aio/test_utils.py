@@ -1,3 +1,6 @@
+import botocore.exceptions
+import pytest
+
 from pyapp_ext.messaging_aws.aio import utils
 
 
@@ -17,3 +20,87 @@ def test_parse_attributes():
     assert actual == {
         "foo": "bar",
     }
+
+
+def test_parse_attributes__binary():
+    actual = utils.parse_attributes({
+        "foo": {"DataType": "String", "StringValue": "bar"},
+        "blob": {"DataType": "Binary", "BinaryValue": b"xx"},
+        "other": {"DataType": "Custom"},
+    })
+
+    assert actual == {"foo": "bar", "blob": b"xx"}
+
+
+def test_build_attributes__typed():
+    actual = utils.build_attributes(count=2, tags=["a", "b"])
+
+    assert actual == {
+        "count": {"DataType": "Number", "StringValue": "2"},
+        "tags": {"DataType": "String.Array", "StringValue": '["a", "b"]'},
+    }
+
+
+def test_parse_sns_attributes():
+    actual = utils.parse_sns_attributes({
+        "foo": {"Type": "String", "Value": "bar"},
+        "count": {"Type": "Number", "Value": "2"},
+        "price": {"Type": "Number", "Value": "2.5"},
+        "tags": {"Type": "String.Array", "Value": '["a", "b"]'},
+    })
+
+    assert actual == {
+        "foo": "bar",
+        "count": 2,
+        "price": 2.5,
+        "tags": ["a", "b"],
+    }
+
+
+@pytest.mark.parametrize("deliver_at, native_delay, expected", (
+    (None, True, (None, 0)),
+    (999.0, True, (None, 0)),
+    (1010.5, True, (None, 11)),
+    (1900.0, True, (None, 900)),
+    (1900.5, True, ("1900.5", 900)),
+    (1010.5, False, ("1010.5", 0)),
+))
+def test_deferred_delivery(deliver_at, native_delay, expected):
+    actual = utils.deferred_delivery(deliver_at, 1000.0, native_delay=native_delay)
+
+    assert actual == expected
+
+
+def test_parse_batch_response():
+    actual = utils.parse_batch_response({
+        "Successful": [{"Id": "0", "MessageId": "abc"}],
+        "Failed": [
+            {"Id": "1", "Code": "InternalError", "SenderFault": False},
+            {"Id": "2", "Code": "InvalidParameterValue", "Message": "Eek", "SenderFault": True},
+        ],
+    }, 3)
+
+    assert actual == ["abc", None, utils.Rejected("InvalidParameterValue", "Eek")]
+
+
+def test_message_size():
+    actual = utils.message_size(utils.RawMessage("SomeData", "text/plain", attributes={"n": 1}))
+
+    # Body, ContentType (name, type and value) and n (name, type and value)
+    assert actual == 8 + (11 + 6 + 10) + (1 + 6 + 1)
+
+
+@pytest.mark.parametrize("error, expected", (
+    (Exception("Eek"), None),
+    (botocore.exceptions.ClientError({"Error": {"Code": "Throttling"}}, "SendMessageBatch"), None),
+    (
+        botocore.exceptions.ClientError(
+            {"Error": {"Code": "BatchRequestTooLong", "Message": "Eek"}}, "SendMessageBatch"
+        ),
+        utils.Rejected("BatchRequestTooLong", "Eek"),
+    ),
+))
+def test_permanent_error(error, expected):
+    actual = utils.permanent_error(error)
+
+    assert actual == expected